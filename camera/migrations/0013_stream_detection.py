@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("camera", "0012_rename_last_ping_camera_stream_start"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stream",
+            name="detection",
+            field=models.BooleanField(default=False),
+        ),
+    ]
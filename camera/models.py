@@ -29,6 +29,8 @@ class Stream(models.Model):
     port = models.PositiveSmallIntegerField(default=554)
     url = models.CharField(max_length=255)
     force_tcp = models.BooleanField(default=True)
+    # Low-resolution substream to decode for detection instead of the main one
+    detection = models.BooleanField(default=False)
 
     camera_type = models.ForeignKey(
         CameraType, on_delete=models.CASCADE, related_name="streams"
@@ -83,11 +85,11 @@ class Camera(models.Model):
 
     stream_start = models.DateTimeField(null=True, blank=True)
 
+    def url(self, stream: Stream):
+        return f"{stream.protocol.lower()}://{self.username}:{self.password}@{self.host}:{stream.port}{stream.url}"
+
     def urls(self):
-        return [
-            f"{stream.protocol.lower()}://{self.username}:{self.password}@{self.host}:{stream.port}{stream.url}"
-            for stream in self.camera_type.streams.all()
-        ]
+        return [self.url(stream) for stream in self.camera_type.streams.all()]
 
     def online(self):
         stream_path = Path(settings.STORAGE_DIR) / f"stream/{self.id}/out.m3u8"
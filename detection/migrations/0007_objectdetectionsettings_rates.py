@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("detection", "0006_alter_motiondetectionregion_color"),
+    ]
+
+    # Existing cameras get 0, inferring on every frame as they did before the
+    # rates; new ones default to the slower idle cadence
+    operations = [
+        migrations.AddField(
+            model_name="objectdetectionsettings",
+            name="idle_rate",
+            field=models.FloatField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="objectdetectionsettings",
+            name="active_rate",
+            field=models.FloatField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="objectdetectionsettings",
+            name="idle_rate",
+            field=models.FloatField(
+                default=1,
+                help_text="Inferences per second while nothing is seen; 0 infers on "
+                "every frame",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="objectdetectionsettings",
+            name="active_rate",
+            field=models.FloatField(
+                default=10,
+                help_text="Inferences per second while objects are seen; 0 infers on "
+                "every frame",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("detection", "0007_objectdetectionsettings_rates"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="motiondetectionsettings",
+            name="mode",
+            field=models.CharField(
+                choices=[("pixels", "Pixels"), ("vectors", "Motion vectors")],
+                default="pixels",
+                max_length=7,
+            ),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("detection", "0008_motiondetectionsettings_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="objectdetectionsettings",
+            name="keyframes_only",
+            field=models.BooleanField(default=False),
+        ),
+    ]
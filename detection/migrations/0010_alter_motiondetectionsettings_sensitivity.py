@@ -0,0 +1,33 @@
+import django.core.validators
+from django.db import migrations, models
+from django.db.models.functions import Greatest, Least
+
+
+def clamp_sensitivity(apps, schema_editor):
+    # Values outside 0-1 used to be clamped when detecting; keep what they did
+    settings = apps.get_model("detection", "MotionDetectionSettings")
+    settings.objects.exclude(sensitivity__range=(0, 1)).update(
+        sensitivity=Least(Greatest("sensitivity", 0.0), 1.0)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("detection", "0009_objectdetectionsettings_keyframes_only"),
+    ]
+
+    operations = [
+        migrations.RunPython(clamp_sensitivity, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="motiondetectionsettings",
+            name="sensitivity",
+            field=models.FloatField(
+                help_text="From 0, when 5% of the regions must move, to 1, when any "
+                "change counts",
+                validators=[
+                    django.core.validators.MinValueValidator(0),
+                    django.core.validators.MaxValueValidator(1),
+                ],
+            ),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 
 from colorfield.fields import ColorField
@@ -24,9 +25,20 @@ class MotionDetectionSettings(models.Model):
     class Meta:
         verbose_name_plural = "Motion detection settings"
 
+    class Mode(models.TextChoices):
+        PIXELS = "pixels", "Pixels"
+        # Codec motion vectors; needs PyAV, and only applies to cameras without
+        # other detection or visualization
+        VECTORS = "vectors", "Motion vectors"
+
     enabled = models.BooleanField()
     visualize = models.BooleanField()
-    sensitivity = models.FloatField()
+    sensitivity = models.FloatField(
+        validators=[MinValueValidator(0), MaxValueValidator(1)],
+        help_text="From 0, when 5% of the regions must move, to 1, when any change "
+        "counts",
+    )
+    mode = models.CharField(max_length=7, choices=Mode.choices, default=Mode.PIXELS)
     schedule = models.ForeignKey(
         schedule.Schedule, on_delete=models.RESTRICT, null=True, blank=True
     )
@@ -38,7 +50,7 @@ class MotionDetectionSettings(models.Model):
 class MotionDetectionRegion(models.Model):
     enabled = models.BooleanField()
     color = ColorField(format="hexa")
-    points = models.JSONField()
+    points = models.JSONField()  # Polygon as [[x, y], ...], normalized to 0-1
 
     motion_detection_settings = models.ForeignKey(
         MotionDetectionSettings, on_delete=models.CASCADE, related_name="regions"
@@ -52,6 +64,19 @@ class ObjectDetectionSettings(models.Model):
     enabled = models.BooleanField()
     visualize = models.BooleanField()
     threshold = models.FloatField()
+    # Cameras from before the rates were added keep inferring on every frame
+    idle_rate = models.FloatField(
+        default=1,
+        help_text="Inferences per second while nothing is seen; 0 infers on every "
+        "frame",
+    )
+    active_rate = models.FloatField(
+        default=10,
+        help_text="Inferences per second while objects are seen; 0 infers on every "
+        "frame",
+    )
+    # Only decode keyframes, i.e. detect once per GOP, when the stream allows
+    keyframes_only = models.BooleanField(default=False)
 
     camera = models.OneToOneField(camera.Camera, on_delete=models.CASCADE)
 
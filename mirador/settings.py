@@ -166,7 +166,22 @@ REST_FRAMEWORK = {
 STORAGE_DIR = "/mnt/watchtower"
 MIN_FREE_PERCENT = 10
 MIN_FREE_BYTES = 524288000
+PROBE_CACHE_TTL = 86400  # Seconds; 0 always probes
+TRANSCODE_HWACCEL = True  # Use hardware decoders/encoders that pass a trial run
+CAPABILITY_CACHE_TTL = 604800  # Seconds; also re-probed when ffmpeg changes
 RECORD_SEGMENT_MINS = 15
+SEGMENTER_RELAY = "copy"  # "copy" or "splice" (Linux only)
+RECORD_MUXER = "ffmpeg"  # "ffmpeg" or "native" (H.264 + AAC fragmented MP4)
+RECORD_FORMAT = "fmp4"  # "fmp4" (fragmented, single pass) or "mp4" (+faststart)
+RECORD_AUDIO = "copy"  # "copy" (AAC as-is, anything else encoded to AAC once) or "pcm"
+SPILL_DIR = None  # Local directory for segmenter spill files (default: temp dir)
+INFERENCE_SOCKET = None  # Socket of the shared inference service (`infer`); None loads a model per camera
+ENCODER_THREADS = None  # libx264 threads shared by transcoding cameras; None: all CPUs
+CPU_SCHEDULER = True  # Pin cameras' threads and ffmpeg processes to cores by load
+DETECTOR_BACKEND = "ultralytics"  # Or "onnx" (CPU; exported from YOLO_MODEL once)
+DETECTOR_THREADS = None  # Intra-op threads; None: all CPUs for `infer`, else 1
+DETECTOR_INT8 = False  # ONNX only: quantize the weights to int8
+DRAWBOX_RENDERER = "python"  # "python" (re-encodes decoded frames) or "zmq" (drawn by ffmpeg; needs pyzmq)
 
 OAUTH2_PROVIDER = {
     "PKCE_REQUIRED": False,
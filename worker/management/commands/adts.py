@@ -0,0 +1,62 @@
+from struct import pack
+
+from worker.management.commands.ringbuffer import RingBuffer
+
+ADTS_HEADER_SIZE = 7
+ADTS_CRC_SIZE = 2
+ADTS_FRAME_SAMPLES = 1024
+ADTS_SAMPLE_RATES = [
+    96000,
+    88200,
+    64000,
+    48000,
+    44100,
+    32000,
+    24000,
+    22050,
+    16000,
+    12000,
+    11025,
+    8000,
+    7350,
+]
+
+
+def is_adts_sync(header: bytes):
+    return header[0] == 0xFF and header[1] & 0xF6 == 0xF0
+
+
+def get_adts_frame_size(header: bytes):
+    return (header[3] & 0x03) << 11 | header[4] << 3 | header[5] >> 5
+
+
+def get_adts_header_size(header: bytes):
+    protection_absent = header[1] & 0x01
+    return ADTS_HEADER_SIZE + (0 if protection_absent else ADTS_CRC_SIZE)
+
+
+def get_adts_frames_size(buffer: RingBuffer, limit: int):
+    # Size of the complete frames at the start of the buffer, up to `limit`
+    # unless the first frame alone is bigger
+    size = 0
+    while size + ADTS_HEADER_SIZE <= len(buffer):
+        header = bytes(buffer[size + i] for i in range(ADTS_HEADER_SIZE))
+        frame_size = get_adts_frame_size(header)
+        if not is_adts_sync(header) or frame_size < ADTS_HEADER_SIZE:
+            # Not aligned; let the reader resync
+            return min(len(buffer), limit) if size == 0 else size
+        if size + frame_size > len(buffer) or size and size + frame_size > limit:
+            break
+        size += frame_size
+    return size
+
+
+def get_adts_config(header: bytes):
+    object_type = (header[2] >> 6) + 1
+    sample_rate_index = (header[2] >> 2) & 0x0F
+    channels = (header[2] & 0x01) << 2 | header[3] >> 6
+
+    audio_specific_config = pack(
+        ">H", object_type << 11 | sample_rate_index << 7 | channels << 3
+    )
+    return audio_specific_config, ADTS_SAMPLE_RATES[sample_rate_index], channels
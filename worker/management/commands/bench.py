@@ -0,0 +1,335 @@
+import os
+from multiprocessing import Barrier, Event, Process, Queue
+from resource import RUSAGE_SELF, getrusage
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+import ffmpeg
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from worker.management.commands.constants import (
+    DETECTOR_ONNX,
+    DETECTOR_ULTRALYTICS,
+    HXXX_BUFFER_SIZE,
+    HXXX_NALU_HEADER,
+    READ_MAX_SIZE,
+    RELAY_COPY,
+    RELAY_PIPE_SIZE,
+    RELAY_SPLICE,
+)
+from worker.management.commands.framering import FrameRing
+from worker.management.commands.inference import (
+    InferenceClient,
+    InferenceServer,
+    load_inference_model,
+)
+from worker.management.commands.relay import (
+    EpollPoller,
+    LazyFD,
+    SelectPoller,
+    filter_fds,
+    splice_fds,
+)
+from worker.management.commands.ringbuffer import RingBuffer
+from worker.management.commands.utils import mkfifotemp
+
+BENCH_FRAME_RATE = 30
+BENCH_INFERENCE_PROCESS = "process"
+BENCH_INFERENCE_SERVICE = "service"
+BENCH_DETECTOR_CLIP = "testsrc2=size=1280x720:rate=30"  # When no clip is given
+
+
+def produce_hxxx(path: str, bitrate: float, seconds: float):
+    frame_size = int(bitrate * 1000000 / 8 / BENCH_FRAME_RATE)
+    frame = bytearray(os.urandom(frame_size))
+    frame[: len(HXXX_NALU_HEADER)] = HXXX_NALU_HEADER
+
+    with open(path, "wb", buffering=0) as f:
+        start = perf_counter()
+        for i in range(int(seconds * BENCH_FRAME_RATE)):
+            delay = start + i / BENCH_FRAME_RATE - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            f.write(frame)
+
+
+def consume_hxxx(path: str):
+    read_buffer = bytearray(READ_MAX_SIZE)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(read_buffer):
+            pass
+
+
+def relay_hxxx(engine: str, in_path: str, out_path: str):
+    splice_enabled = engine == RELAY_SPLICE
+    poller = EpollPoller() if splice_enabled else SelectPoller()
+    pipe_size = RELAY_PIPE_SIZE if splice_enabled else 0
+
+    in_fd = LazyFD(in_path, os.O_RDONLY, "r")
+    out_fd = LazyFD(out_path, os.O_WRONLY, "w", pipe_size)
+    buffer = RingBuffer(HXXX_BUFFER_SIZE)
+    in_stats = 0
+
+    while True:
+        _rlist = [in_fd] if buffer.free() else []
+        _wlist = [out_fd] if len(buffer) else []
+        rlist, wlist = poller.poll(filter_fds(_rlist), filter_fds(_wlist), 1)
+
+        if in_fd in rlist:
+            num_bytes = None
+            if splice_enabled and not len(buffer):
+                num_bytes = splice_fds(in_fd, out_fd, READ_MAX_SIZE)
+            if num_bytes is None:
+                num_bytes = in_fd._fileio.readinto(buffer.write_span())
+                buffer.commit(num_bytes)
+            if not num_bytes and in_stats:
+                break
+            in_stats += num_bytes
+
+        if out_fd in wlist:
+            num_bytes = out_fd._fileio.write(buffer.read_span())
+            buffer.consume(num_bytes)
+
+    os.set_blocking(out_fd.fileno(), True)
+    while len(buffer):
+        buffer.consume(out_fd._fileio.write(buffer.read_span()))
+
+    poller.close()
+    in_fd.close()
+    out_fd.close()
+
+    return in_stats
+
+
+def bench_relay(engine: str, bitrate: float, seconds: float):
+    in_path = mkfifotemp("h264")
+    out_path = mkfifotemp("h264")
+
+    producer = Process(target=produce_hxxx, args=(in_path, bitrate, seconds))
+    consumer = Process(target=consume_hxxx, args=(out_path,))
+    producer.start()
+    consumer.start()
+
+    usage_start = getrusage(RUSAGE_SELF)
+    start = perf_counter()
+    num_bytes = relay_hxxx(engine, in_path, out_path)
+    wall = perf_counter() - start
+    usage_end = getrusage(RUSAGE_SELF)
+
+    producer.join()
+    consumer.join()
+    for path in (in_path, out_path):
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    user = usage_end.ru_utime - usage_start.ru_utime
+    system = usage_end.ru_stime - usage_start.ru_stime
+    return num_bytes, wall, user, system
+
+
+def infer_in_process(size, seconds: float, barrier: Barrier, counts: Queue):
+    width, height = size
+    frame = np.random.randint(0, 256, (height, width, 3), np.uint8)
+    model = load_inference_model()
+
+    barrier.wait()
+    count = 0
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        model.predict([frame])
+        count += 1
+    counts.put(count)
+
+
+def infer_with_service(
+    address: str, size, seconds: float, barrier: Barrier, counts: Queue
+):
+    width, height = size
+    frame_ring = FrameRing((height, width, 3), 2)
+    client = InferenceClient(os.getpid(), frame_ring, address)
+
+    barrier.wait()
+    count = 0
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        frame_ring.write_slot()[:] = np.random.randint(0, 256, 3, np.uint8)
+        client.track(frame_ring.commit())
+        count += 1
+    counts.put(count)
+
+    client.close()
+    frame_ring.close()
+
+
+def serve_inference(address: str, stop: Event):
+    InferenceServer(load_inference_model(), address).serve(stop)
+
+
+def bench_inference(mode: str, cameras: int, size, seconds: float):
+    barrier = Barrier(cameras)
+    counts = Queue()
+    server = None
+    stop = Event()
+
+    if mode == BENCH_INFERENCE_SERVICE:
+        tmp_dir = mkdtemp()
+        address = f"{tmp_dir}/infer.sock"
+        server = Process(target=serve_inference, args=(address, stop))
+        server.start()
+        while not os.path.exists(address):
+            sleep(0.1)
+        target, args = infer_with_service, (address, size, seconds, barrier, counts)
+    else:
+        target, args = infer_in_process, (size, seconds, barrier, counts)
+
+    workers = [Process(target=target, args=args) for _ in range(cameras)]
+    for worker in workers:
+        worker.start()
+    frames = sum(counts.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+
+    if server is not None:
+        stop.set()
+        server.join()
+        # Closing the listener removed the socket
+        os.rmdir(tmp_dir)
+
+    return frames / seconds
+
+
+def read_clip(clip: str | None, size, num_frames: int):
+    # Every backend runs on the same decoded frames
+    width, height = size
+    clip_input = (
+        ffmpeg.input(clip)
+        if clip is not None
+        else ffmpeg.input(BENCH_DETECTOR_CLIP, f="lavfi")
+    )
+    out, _ = (
+        clip_input.filter("scale", width, height)
+        .output("pipe:", format="rawvideo", pix_fmt="rgb24", vframes=num_frames)
+        .run(capture_stdout=True, quiet=True)
+    )
+    return np.frombuffer(out, np.uint8).reshape(-1, height, width, 3)
+
+
+def run_detector(
+    backend: str, threads: int, int8: bool, frames, seconds: float, results: Queue
+):
+    model = load_inference_model(backend, threads, int8)
+
+    latencies = []
+    detections = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        frame = frames[len(latencies) % len(frames)]
+        frame_start = perf_counter()
+        detections += len(model.predict([frame])[0])
+        latencies.append(perf_counter() - frame_start)
+    results.put((latencies, perf_counter() - start, detections))
+
+
+def bench_detector(backend: str, threads: int, int8: bool, frames, seconds: float):
+    # Each backend gets a fresh process, as thread settings are process-wide
+    results = Queue()
+    process = Process(
+        target=run_detector, args=(backend, threads, int8, frames, seconds, results)
+    )
+    process.start()
+    latencies, wall, detections = results.get()
+    process.join()
+
+    return len(latencies) / wall, np.array(latencies) * 1000, detections
+
+
+class Command(BaseCommand):
+    help = "Benchmarks worker components"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="target", required=True)
+
+        relay_parser = subparsers.add_parser("relay")
+        relay_parser.add_argument(
+            "--engine",
+            action="append",
+            choices=[RELAY_COPY, RELAY_SPLICE],
+        )
+        relay_parser.add_argument("--bitrate", type=float, default=8)
+        relay_parser.add_argument("--seconds", type=float, default=20)
+
+        inference_parser = subparsers.add_parser("inference")
+        inference_parser.add_argument(
+            "--mode",
+            action="append",
+            choices=[BENCH_INFERENCE_PROCESS, BENCH_INFERENCE_SERVICE],
+        )
+        inference_parser.add_argument("--cameras", type=int, default=4)
+        inference_parser.add_argument("--width", type=int, default=640)
+        inference_parser.add_argument("--height", type=int, default=360)
+        inference_parser.add_argument("--seconds", type=float, default=20)
+
+        detector_parser = subparsers.add_parser("detector")
+        detector_parser.add_argument(
+            "--backend",
+            action="append",
+            choices=[DETECTOR_ULTRALYTICS, DETECTOR_ONNX],
+        )
+        detector_parser.add_argument("--clip", help="Defaults to a test pattern")
+        detector_parser.add_argument("--frames", type=int, default=100)
+        detector_parser.add_argument("--width", type=int, default=640)
+        detector_parser.add_argument("--height", type=int, default=360)
+        detector_parser.add_argument("--threads", type=int, default=os.cpu_count())
+        detector_parser.add_argument("--int8", action="store_true")
+        detector_parser.add_argument("--seconds", type=float, default=20)
+
+    def handle(self, *args, **options):
+        if options["target"] == "relay":
+            self.handle_relay(**options)
+        elif options["target"] == "inference":
+            self.handle_inference(**options)
+        elif options["target"] == "detector":
+            self.handle_detector(**options)
+
+    def handle_relay(self, engine, bitrate, seconds, **options):
+        print(f"Relaying {bitrate} Mbps of video for {seconds} secs per engine...")
+        print()
+        print(f"{'Engine':8} {'MB':>8} {'User (s)':>10} {'Sys (s)':>10} {'CPU':>8}")
+        for e in engine or [RELAY_COPY, RELAY_SPLICE]:
+            num_bytes, wall, user, system = bench_relay(e, bitrate, seconds)
+            cpu = (user + system) / wall * 100
+            print(
+                f"{e:8} {num_bytes / 1048576:8.1f} {user:10.3f} {system:10.3f} {cpu:7.2f}%",
+                flush=True,
+            )
+
+    def handle_inference(self, mode, cameras, width, height, seconds, **options):
+        print(f"Running inference on {cameras} cameras of {width}x{height} frames")
+        print(f"for {seconds} secs per mode...")
+        print()
+        print(f"{'Mode':8} {'Frames/s':>10} {'Per camera':>12}")
+        for m in mode or [BENCH_INFERENCE_PROCESS, BENCH_INFERENCE_SERVICE]:
+            frame_rate = bench_inference(m, cameras, (width, height), seconds)
+            print(f"{m:8} {frame_rate:10.2f} {frame_rate / cameras:12.2f}", flush=True)
+
+    def handle_detector(
+        self, backend, clip, frames, width, height, threads, int8, seconds, **options
+    ):
+        clip_frames = read_clip(clip, (width, height), frames)
+        print(f"Detecting objects in {len(clip_frames)} frames of {width}x{height}")
+        print(f"with {threads} threads for {seconds} secs per backend...")
+        print()
+        print(
+            f"{'Backend':12} {'Frames/s':>10} {'Mean (ms)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'Boxes':>8}"
+        )
+        for b in backend or [settings.DETECTOR_BACKEND]:
+            frame_rate, latencies, detections = bench_detector(
+                b, threads, int8, clip_frames, seconds
+            )
+            p50, p95 = np.percentile(latencies, [50, 95])
+            print(
+                f"{b:12} {frame_rate:10.2f} {latencies.mean():10.2f} {p50:10.2f} {p95:10.2f} {detections:8}",
+                flush=True,
+            )
@@ -0,0 +1,227 @@
+import json
+from fcntl import LOCK_EX, flock
+from os import makedirs, replace
+from socket import gethostname
+from subprocess import SubprocessError, run
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import time
+
+from django.conf import settings
+
+from worker.management.commands.constants import (
+    CAPABILITY_BUSY_ERRORS,
+    CAPABILITY_RETRY_TTL,
+    CAPABILITY_TRIAL_FRAMES,
+    CAPABILITY_TRIAL_TIMEOUT,
+    ENCODER_FILTERS,
+    ENCODER_PARAMS,
+    HWACCEL_DECODERS,
+    PROBE_CACHE_DIR,
+    VIDEO_ENCODERS,
+)
+
+_capabilities = None
+_filters = None
+
+
+def run_ffmpeg(*args: str):
+    return run(
+        ["ffmpeg", "-hide_banner", *args],
+        capture_output=True,
+        text=True,
+        timeout=CAPABILITY_TRIAL_TIMEOUT,
+        check=False,  # Trials fail on purpose; callers look at the return code
+    )
+
+
+def get_ffmpeg_version():
+    return run_ffmpeg("-version").stdout.split("\n")[0]
+
+
+def list_hwaccels():
+    lines = run_ffmpeg("-hwaccels").stdout.split("\n")
+    return [line.strip() for line in lines[1:] if line.strip()]
+
+
+def list_encoders():
+    encoders = []
+    for line in run_ffmpeg("-encoders").stdout.split("\n"):
+        parts = line.split()
+        # e.g. " V....D libx264  libx264 H.264 / AVC ..."; the legend's
+        # " V..... = Video" is not one
+        if len(parts) < 2 or parts[1] == "=":
+            continue
+        if len(parts[0]) == 6 and parts[0][0] == "V":
+            encoders.append(parts[1])
+    return encoders
+
+
+def get_filters():
+    global _filters
+    if _filters is None:
+        _filters = []
+        for line in run_ffmpeg("-filters").stdout.split("\n"):
+            parts = line.split()
+            # e.g. " T.C drawbox  V->V  Draw a colored box on the input video."
+            if len(parts) >= 3 and "->" in parts[2]:
+                _filters.append(parts[1])
+    return _filters
+
+
+def get_encoder_args(encoder: str):
+    args = []
+    for k, v in ENCODER_PARAMS.get(encoder, {}).items():
+        args += [f"-{k}", str(v)]
+    filters = [
+        "=".join(filter_args) for filter_args in ENCODER_FILTERS.get(encoder, [])
+    ]
+    if len(filters):
+        args += ["-vf", ",".join(filters)]
+    return args
+
+
+def run_trial(*args: str):
+    # None when the trial timed out or the device was busy, which says nothing
+    # about what the host supports
+    try:
+        result = run_ffmpeg(*args)
+    except SubprocessError:
+        return None
+    if result.returncode == 0:
+        return True
+    errors = result.stderr.lower()
+    if any(error in errors for error in CAPABILITY_BUSY_ERRORS):
+        return None
+    return False
+
+
+def trial_encode(encoder: str, path: str):
+    return run_trial(
+        "-v",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        "testsrc2=size=640x360:rate=25",
+        "-frames:v",
+        str(CAPABILITY_TRIAL_FRAMES),
+        *get_encoder_args(encoder),
+        "-vcodec",
+        encoder,
+        "-f",
+        "h264",
+        "-y",
+        path,
+    )
+
+
+def trial_decode(hwaccel: str, path: str):
+    # Keeping frames on the device stops ffmpeg from quietly falling back to
+    # software decoding
+    return run_trial(
+        "-v",
+        "error",
+        "-hwaccel",
+        hwaccel,
+        "-hwaccel_output_format",
+        hwaccel,
+        "-i",
+        path,
+        "-f",
+        "null",
+        "-",
+    )
+
+
+def probe_capabilities():
+    available_hwaccels = list_hwaccels()
+    available_encoders = list_encoders()
+
+    # Also returns whether every trial was conclusive
+    encoders, hwaccels, conclusive = [], [], True
+    with TemporaryDirectory() as tmp_dir:
+        sample_path = None
+        for encoder in VIDEO_ENCODERS:
+            if encoder not in available_encoders:
+                continue
+            path = f"{tmp_dir}/{encoder}.h264"
+            works = trial_encode(encoder, path)
+            conclusive = conclusive and works is not None
+            if works:
+                encoders.append(encoder)
+                sample_path = sample_path or path
+
+        if sample_path is not None:
+            for hwaccel in HWACCEL_DECODERS:
+                if hwaccel not in available_hwaccels:
+                    continue
+                works = trial_decode(hwaccel, sample_path)
+                conclusive = conclusive and works is not None
+                if works:
+                    hwaccels.append(hwaccel)
+
+    return {"hwaccels": hwaccels, "encoders": encoders}, conclusive
+
+
+def get_capabilities_path():
+    return f"{settings.STORAGE_DIR}/{PROBE_CACHE_DIR}/host-{gethostname()}"
+
+
+def read_capabilities(path: str, version: str):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache["version"] == version and time() - cache["time"] < cache["ttl"]:
+            return cache["capabilities"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def get_capabilities():
+    global _capabilities
+    if _capabilities is not None:
+        return _capabilities
+
+    path = get_capabilities_path()
+    version = get_ffmpeg_version()
+    _capabilities = read_capabilities(f"{path}.json", version)
+    if _capabilities is not None:
+        return _capabilities
+
+    # Workers usually all start at boot; the first one probes while the others
+    # wait for its results, so no two trials compete for a device
+    cache_dir = f"{settings.STORAGE_DIR}/{PROBE_CACHE_DIR}"
+    makedirs(cache_dir, exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        flock(lock, LOCK_EX)
+        _capabilities = read_capabilities(f"{path}.json", version)
+        if _capabilities is not None:
+            return _capabilities
+
+        print(f"Probing ffmpeg capabilities on {gethostname()}...", flush=True)
+        _capabilities, conclusive = probe_capabilities()
+        print(f"- Hardware decoders: {_capabilities['hwaccels']}")
+        print(f"- Video encoders:    {_capabilities['encoders']}", flush=True)
+
+        # Busy devices and timeouts are probed again soon rather than missed
+        # for the whole TTL
+        ttl = settings.CAPABILITY_CACHE_TTL if conclusive else CAPABILITY_RETRY_TTL
+        if not conclusive:
+            print(f"- Some trials timed out or were busy; caching for {ttl}s only")
+
+        # Written aside and moved into place, so a worker killed while writing
+        # leaves the previous file whole
+        with NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(
+                {
+                    "version": version,
+                    "time": time(),
+                    "ttl": ttl,
+                    "capabilities": _capabilities,
+                },
+                f,
+            )
+        replace(f.name, f"{path}.json")
+
+    return _capabilities
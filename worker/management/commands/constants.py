@@ -1,10 +1,31 @@
 CODEC_H264 = "h264"
 CODEC_HEVC = "hevc"
 CODEC_RAWAUDIO = "s16le"
+CODEC_ADTS = "adts"
 AUDIO_RATE = 16000
 
 
-DECODE_SIZE = 1280, 720
+DETECTOR_ULTRALYTICS = "ultralytics"
+DETECTOR_ONNX = "onnx"
+DETECTOR_INPUT_SIZE = 640
+DETECTOR_PAD_VALUE = 114
+DETECTOR_CONF_MIN = 0.25
+DETECTOR_IOU_MAX = 0.7  # Overlap above which the less confident box is dropped
+DETECTOR_DETECTIONS_MAX = 300
+
+DECODE_SIZE_MAX = DETECTOR_INPUT_SIZE  # Longest side
+DRAWBOX_DECODE_SIZE_MAX = 1280  # Visualized frames get recorded too
+
+DRAWBOX_RENDERER_PYTHON = "python"
+DRAWBOX_RENDERER_ZMQ = "zmq"
+DRAWBOX_SLOTS = 16  # Boxes ffmpeg can draw at once; the most confident win
+DRAWBOX_COLOR = "0x00FF00"
+DRAWBOX_THICKNESS = 2
+DRAWBOX_FONT_SIZE = 16
+
+FRAME_RING_SLOTS = 4
+PIPELINE_STAT_PERIOD = 10
+PIPELINE_FRAME_TIMEOUT = 1
 
 FF_GLOBAL_PARAMS = {
     "hide_banner": None,
@@ -19,24 +40,118 @@ for k, v in FF_GLOBAL_PARAMS.items():
 
 FF_RTSP_DEFAULT_PARAMS = {"stimeout": 5000000}
 
+# In order of preference
+HWACCEL_DECODERS = ["cuda", "vaapi"]
+VIDEO_ENCODERS = ["h264_nvenc", "h264_vaapi", "libx264"]
+
+VAAPI_DEVICE = "/dev/dri/renderD128"
+ENCODER_PARAMS = {
+    "h264_nvenc": {"bf": 0},
+    "h264_vaapi": {"vaapi_device": VAAPI_DEVICE},
+    "libx264": {"preset": "veryfast"},
+}
+ENCODER_FILTERS = {
+    "h264_vaapi": [("format", "nv12"), ("hwupload",)],
+}
+X264_THREADS_MAX = 4
+X264_TIERS = [  # Pixels per second per thread up to which a preset keeps up
+    (20000000, "faster", 20),  # Preset, lookahead frames
+    (45000000, "veryfast", 10),
+    (90000000, "superfast", 0),
+    (None, "ultrafast", 0),
+]
+ENCODER_BOARD = "mirador-encoders.json"  # In the temp dir; shared by all workers
+
+CAPABILITY_TRIAL_FRAMES = 10
+CAPABILITY_TRIAL_TIMEOUT = 30
+CAPABILITY_RETRY_TTL = 600  # Seconds; for probes where a trial timed out or was busy
+CAPABILITY_BUSY_ERRORS = ["busy", "out of memory", "temporarily unavailable"]
+
 HXXX_CODECS = ["h264", "hevc"]
 HXXX_NALU_HEADER = b"\x00\x00\x00\x01\x67"
-HXXX_NALU_HEADER_SIZE = len(HXXX_NALU_HEADER)
+
+INFERENCE_BATCH_MAX = 16
+INFERENCE_BATCH_WAIT = 0.01  # Seconds a frame may wait for others to batch with
+INFERENCE_CHECK_PERIOD = 1
+INFERENCE_WARMUP_SIZE = 640
 
 RAWAUDIO_SAMPLE_SIZE = 2
 
 READ_MAX_SIZE = 1048576
 
+RELAY_COPY = "copy"
+RELAY_SPLICE = "splice"
+RELAY_PIPE_SIZE = 1048576
+
+PROBE_CACHE_DIR = "probe"
+PROBE_CACHE_MIN_UPTIME = 60  # Streams that fail sooner re-probe on restart
+
 RECORD_DIR = "record"
 RECORD_FILENAME = "VID_%Y%m%d_%H%M%S.mp4"
+RECORD_MUXER_FFMPEG = "ffmpeg"
+RECORD_MUXER_NATIVE = "native"
+RECORD_FRAGMENT_SECS = 4
+RECORD_PREWARM_SECS = 10
+RECORD_AUDIO_COPY = "copy"
+RECORD_AUDIO_PCM = "pcm"
+RECORD_AUDIO_COPY_CODECS = ["aac"]  # Source codecs that fit in ADTS and MP4
+RECORD_FORMAT_MP4 = "mp4"
+RECORD_FORMAT_FMP4 = "fmp4"
+RECORD_MOVFLAGS = {
+    RECORD_FORMAT_MP4: "+faststart",
+    RECORD_FORMAT_FMP4: "+frag_keyframe+empty_moov+default_base_moof",
+}
 
 STAT_CHECK_PERIOD = 5
 STALL_PERIOD_MAX = 12
 
-HXXX_OFLOW = 1 * 1024 * 1024 * 5  # 5 seconds of 8Mbps video
-RAWAUDIO_OFLOW = 8000 * 2 * 5  # 5 seconds of 44.1kHz audio
+# In-memory ring buffers; input that doesn't fit spills to a file on disk
+HXXX_BUFFER_SIZE = 1 * 1024 * 1024 * 10  # 10 seconds of 8Mbps video
+RAWAUDIO_BUFFER_SIZE = 16000 * 2 * 10  # 10 seconds of 16kHz audio
+SPILL_SECS = 120
 OFLOW_PERIOD_MAX = 12
 
 STREAM_DIR = "stream"
 
+SUPERVISOR_CHECK_PERIOD = 1
+SUPERVISOR_BACKOFF_MIN = 5
+SUPERVISOR_BACKOFF_MAX = 300
+SUPERVISOR_BACKOFF_RESET = 600  # Uptime after which a camera counts as healthy
+SUPERVISOR_INFERENCE_WAIT = 0.1  # Seconds between checks for the socket
+
+SCHEDULER_BOARD = "mirador-cpus.json"  # In the temp dir; shared by all workers
+SCHEDULER_PERIOD = 10  # Seconds between load measurements
+SCHEDULER_STALE_SECS = 60  # Cameras not updated for this long are gone
+SCHEDULER_LOAD_DEFAULT = 1  # Cores a camera is assumed to need until measured
+SCHEDULER_LOAD_CHANGE = 0.25  # Relative change needed to move a camera
+
+DETECT_ACTIVE_HOLD_SECS = 5  # Stay at the active rate after objects disappear
+DETECT_RATE_DEFAULT = 10, 10  # Idle, active; without object detection settings
+PROPAGATE_MAX_SECS = 1  # Boxes only move this far past their last inference
+
+MOTION_SIZE_MAX = 160  # Longest side of the frames motion is detected on
+MOTION_PIXEL_THRESHOLD = 25  # Gray levels a pixel must change by
+MOTION_AREA_MAX = 0.05  # Moving share of the regions needed at sensitivity 0
+MOTION_BACKGROUND_ALPHA = 0.05
+MOTION_HOLD_SECS = 2  # Keep detecting objects after motion stops
+MOTION_MODE_PIXELS = "pixels"
+MOTION_MODE_VECTORS = "vectors"
+MOTION_VECTOR_THRESHOLD = 1  # Pixels a block must move by
+MOTION_FRAME_SIZE_GATE = 1.2  # Times a still scene's P-frame size to look at vectors
+MOTION_FRAME_SIZE_ALPHA = 0.05
+MOTION_VECTOR_CHUNK_SIZE = 64 * 1024
+MOTION_VECTOR_QUEUE_SIZE = 64  # Chunks; a decoder further behind skips to a keyframe
+
+EVENT_TYPE_OBJECT = "object"
+EVENT_TYPE_MOTION = "motion"
+EVENT_TRACK_TIMEOUT = 5  # Seconds after its last detection that a track ends
+EVENT_DURATION_MAX = 600  # Longer tracks are split into several events
+EVENT_BATCH_MAX = 500
+EVENT_BATCH_WAIT = 2  # Seconds an event may wait for others to be written with
+EVENT_WRITE_ATTEMPTS = 3  # Batches that still fail are dropped
+EVENT_RETRY_WAIT = 2
+
+TRACKER_IOU_MIN = 0.3
+TRACKER_MAX_AGE = 30  # Frames a track survives without a matching detection
+
 YOLO_MODEL = "yolov8n.pt"
@@ -0,0 +1,180 @@
+from abc import ABC, abstractmethod
+from ast import literal_eval
+from os import sched_getaffinity
+from os.path import exists, splitext
+
+import numpy as np
+from django.conf import settings
+
+from worker.management.commands.constants import (
+    DETECTOR_CONF_MIN,
+    DETECTOR_DETECTIONS_MAX,
+    DETECTOR_INPUT_SIZE,
+    DETECTOR_IOU_MAX,
+    DETECTOR_ONNX,
+    DETECTOR_PAD_VALUE,
+    YOLO_MODEL,
+)
+from worker.management.commands.tracker import get_ious
+
+_torch_threads = None
+
+
+class Detector(ABC):
+    # Backends map class IDs to `names` and return, for each frame, rows of
+    # x1, y1, x2, y2, confidence, class in the frame's own coordinates
+    names: dict[int, str]
+
+    @abstractmethod
+    def predict(self, frames): ...
+
+
+def set_torch_threads(threads: int):
+    # torch's thread count is process-wide, so the first caller decides it:
+    # a supervisor running many cameras before any of them loads a model
+    global _torch_threads
+    if _torch_threads is None:
+        _torch_threads = threads
+
+
+class UltralyticsDetector(Detector):
+    def __init__(self, threads: int):
+        import torch
+        from ultralytics import YOLO
+
+        set_torch_threads(threads)
+        torch.set_num_threads(_torch_threads)
+        # Half precision only pays off on GPUs
+        self.half = torch.cuda.is_available()
+        self.model = YOLO(YOLO_MODEL)
+        self.names = self.model.names
+
+    def predict(self, frames):
+        results = self.model.predict(frames, half=self.half, verbose=False)
+        return [result.boxes.data.cpu().numpy()[:, :6] for result in results]
+
+
+def get_onnx_path(int8: bool):
+    # Exported once next to the weights, then quantized if asked to
+    path = f"{splitext(YOLO_MODEL)[0]}.onnx"
+    if not exists(path):
+        from ultralytics import YOLO
+
+        print(f"Exporting {YOLO_MODEL} to ONNX...", flush=True)
+        path = YOLO(YOLO_MODEL).export(
+            format="onnx", imgsz=DETECTOR_INPUT_SIZE, dynamic=True, simplify=True
+        )
+    if not int8:
+        return path
+
+    int8_path = f"{splitext(path)[0]}-int8.onnx"
+    if not exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"Quantizing {path} to int8...", flush=True)
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+
+def letterbox(frame, size: int):
+    # Nearest-neighbour scaling; decoded frames are mostly at the detector's
+    # input size already, and only need padding
+    height, width = frame.shape[:2]
+    scale = min(size / width, size / height)
+    new_width, new_height = round(width * scale), round(height * scale)
+    if (new_width, new_height) != (width, height):
+        xs = np.minimum((np.arange(new_width) / scale).astype(int), width - 1)
+        ys = np.minimum((np.arange(new_height) / scale).astype(int), height - 1)
+        frame = frame[ys[:, None], xs]
+
+    pad_x, pad_y = (size - new_width) // 2, (size - new_height) // 2
+    image = np.full((size, size, 3), DETECTOR_PAD_VALUE, np.uint8)
+    image[pad_y : pad_y + new_height, pad_x : pad_x + new_width] = frame
+    return image, scale, (pad_x, pad_y)
+
+
+def non_max_suppression(boxes, scores, iou_max: float):
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(order) and len(keep) < DETECTOR_DETECTIONS_MAX:
+        keep.append(order[0])
+        ious = get_ious(boxes[order[:1]], boxes[order[1:]])[0]
+        order = order[1:][ious <= iou_max]
+    return np.array(keep, int)
+
+
+class OnnxDetector(Detector):
+    def __init__(self, threads: int, int8: bool):
+        import onnxruntime
+
+        path = get_onnx_path(int8)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = literal_eval(metadata["names"]) if "names" in metadata else {}
+
+    def predict(self, frames):
+        images, transforms = [], []
+        for frame in frames:
+            image, scale, pad = letterbox(frame, DETECTOR_INPUT_SIZE)
+            images.append(image)
+            transforms.append((scale, pad))
+
+        batch = np.stack(images).transpose(0, 3, 1, 2).astype(np.float32) / 255
+        outputs = self.session.run(None, {self.input_name: batch})[0]
+
+        # Rows of center x, center y, width, height, then one score per class
+        results = []
+        for output, (scale, (pad_x, pad_y)) in zip(outputs, transforms):
+            output = output.T
+            classes = output[:, 4:].argmax(1)
+            scores = output[np.arange(len(output)), 4 + classes]
+            candidates = scores >= DETECTOR_CONF_MIN
+            output, classes, scores = (
+                output[candidates],
+                classes[candidates],
+                scores[candidates],
+            )
+
+            boxes = np.column_stack(
+                [
+                    output[:, 0] - output[:, 2] / 2,
+                    output[:, 1] - output[:, 3] / 2,
+                    output[:, 0] + output[:, 2] / 2,
+                    output[:, 1] + output[:, 3] / 2,
+                ]
+            )
+            # Boxes of different classes never suppress each other
+            offsets = classes[:, None] * (DETECTOR_INPUT_SIZE + 1)
+            keep = non_max_suppression(boxes + offsets, scores, DETECTOR_IOU_MAX)
+
+            boxes = (boxes[keep] - [pad_x, pad_y, pad_x, pad_y]) / scale
+            results.append(
+                np.column_stack([boxes, scores[keep], classes[keep]]).astype(np.float32)
+            )
+        return results
+
+
+def get_detector_threads(shared: bool):
+    # A shared detector gets every CPU it may run on; one per camera only
+    # gets the CPU its pipeline is pinned to
+    if settings.DETECTOR_THREADS is not None:
+        return settings.DETECTOR_THREADS
+    return len(sched_getaffinity(0)) if shared else 1
+
+
+def load_detector(backend: str, threads: int, int8: bool | None = None):
+    if backend == DETECTOR_ONNX:
+        int8 = settings.DETECTOR_INT8 if int8 is None else int8
+        return OnnxDetector(threads, int8)
+    return UltralyticsDetector(threads)
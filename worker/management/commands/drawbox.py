@@ -0,0 +1,103 @@
+import numpy as np
+
+from worker.management.commands.constants import (
+    DRAWBOX_COLOR,
+    DRAWBOX_FONT_SIZE,
+    DRAWBOX_SLOTS,
+    DRAWBOX_THICKNESS,
+)
+from worker.management.commands.inference import get_label
+
+
+def add_drawbox_filters(video, address: str):
+    # A fixed set of hidden boxes and labels, which the pipeline moves around
+    # through the zmq filter
+    video = video.filter("zmq", bind_address=address)
+    for i in range(DRAWBOX_SLOTS):
+        video = video.filter(
+            f"drawbox@box{i}",
+            x=0,
+            y=0,
+            w=1,
+            h=1,
+            color=DRAWBOX_COLOR,
+            t=DRAWBOX_THICKNESS,
+            enable=0,
+        )
+        video = video.filter(
+            f"drawtext@label{i}",
+            text="-",  # Hidden until reinit; drawtext won't take an empty text
+            x=0,
+            y=0,
+            fontsize=DRAWBOX_FONT_SIZE,
+            fontcolor=DRAWBOX_COLOR,
+            expansion="none",
+            enable=0,
+        )
+    return video
+
+
+def escape_option(value: str):
+    return "".join(f"\\{c}" if c in "\\':=" else c for c in value)
+
+
+class DrawboxClient:
+    def __init__(self, address: str, scale):
+        import zmq
+
+        # Commands are sent without waiting for replies, so that the filter
+        # applies all of them at the next frame
+        self.socket = zmq.Context.instance().socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        self.scale = np.array([*scale, *scale])
+        self._slots = [None] * DRAWBOX_SLOTS
+
+    def _send(self, target: str, command: str, arg):
+        self.socket.send_multipart([b"", f"{target} {command} {arg}".encode()])
+
+    def _drain(self):
+        import zmq
+
+        while True:
+            try:
+                self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+    def draw(self, detections, names):
+        # Only what changed since the last call is sent
+        detections = detections[np.argsort(-detections[:, 4], kind="stable")]
+        for i, previous in enumerate(self._slots):
+            box, text = f"drawbox@box{i}", f"drawtext@label{i}"
+            state = None
+            if i < len(detections):
+                x1, y1, x2, y2 = np.round(detections[i, :4] * self.scale).astype(int)
+                label = get_label(names, *detections[i, 4:7])
+                state = (x1, y1, max(x2 - x1, 1), max(y2 - y1, 1), label)
+
+            if state == previous:
+                continue
+            self._slots[i] = state
+            if state is None:
+                self._send(box, "enable", 0)
+                self._send(text, "enable", 0)
+                continue
+
+            for j, key in enumerate("xywh"):
+                if previous is None or previous[j] != state[j]:
+                    self._send(box, key, state[j])
+            x, y, _, _, label = state
+            if previous is None or previous[:2] != (x, y) or previous[4] != label:
+                text_y = max(y - DRAWBOX_FONT_SIZE - 4, 0)
+                self._send(
+                    text, "reinit", f"text={escape_option(label)}:x={x}:y={text_y}"
+                )
+            if previous is None:
+                self._send(box, "enable", 1)
+                self._send(text, "enable", 1)
+
+        self._drain()
+
+    def close(self):
+        self.socket.close()
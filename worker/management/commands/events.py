@@ -0,0 +1,193 @@
+from datetime import UTC, datetime
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from traceback import print_exception
+
+import numpy as np
+from django.db import DatabaseError, connection
+
+from storage.models import Event
+from worker.management.commands.constants import (
+    EVENT_BATCH_MAX,
+    EVENT_BATCH_WAIT,
+    EVENT_DURATION_MAX,
+    EVENT_RETRY_WAIT,
+    EVENT_TRACK_TIMEOUT,
+    EVENT_TYPE_MOTION,
+    EVENT_TYPE_OBJECT,
+    EVENT_WRITE_ATTEMPTS,
+)
+
+_event_writer = None
+_event_writer_lock = Lock()
+
+
+def get_date(timestamp: float):
+    return datetime.fromtimestamp(timestamp, UTC)
+
+
+class EventWriter:
+    # One thread per process writes the events of all its cameras, a batch
+    # at a time
+    def __init__(self):
+        self.queue: Queue[Event] = Queue()
+        self.written = 0
+        Thread(target=self._run, name="event-writer", daemon=True).start()
+
+    def put(self, event: Event):
+        self.queue.put(event)
+
+    def flush(self):
+        self.queue.join()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = monotonic() + EVENT_BATCH_WAIT
+        while len(batch) < EVENT_BATCH_MAX:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # A batch that still can't be written after a few attempts is dropped;
+        # events are best-effort and must not hold up the cameras
+        for attempt in range(1, EVENT_WRITE_ATTEMPTS + 1):
+            try:
+                Event.objects.bulk_create(batch)
+                self.written += len(batch)
+                return
+            except DatabaseError as e:
+                print(f"Failed to write {len(batch)} events ({attempt}):")
+                print_exception(e)
+                connection.close()
+            if attempt < EVENT_WRITE_ATTEMPTS:
+                sleep(EVENT_RETRY_WAIT)
+        print(f"Dropped {len(batch)} events.", flush=True)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def get_event_writer():
+    global _event_writer
+    with _event_writer_lock:
+        if _event_writer is None:
+            _event_writer = EventWriter()
+    return _event_writer
+
+
+class Track:
+    def __init__(self, detection, now: float):
+        self.class_id = int(detection[5])
+        self.start = now
+        self.end = now
+        self.confidence = float(detection[4])
+        self.count = 1
+        self.first_box = detection[:4].copy()
+        self.last_box = detection[:4].copy()
+        self.union_box = detection[:4].copy()
+
+    def update(self, detection, now: float):
+        self.end = now
+        self.confidence = max(self.confidence, float(detection[4]))
+        self.count += 1
+        self.last_box = detection[:4].copy()
+        self.union_box[:2] = np.minimum(self.union_box[:2], detection[:2])
+        self.union_box[2:] = np.maximum(self.union_box[2:], detection[2:4])
+
+
+class EventCollector:
+    # Collapses a camera's tracked detections into one event per track, from
+    # when it was first to when it was last detected; spans of motion come
+    # in whole
+    def __init__(self, camera_id, frame_size, names):
+        self.camera_id = camera_id
+        width, height = frame_size
+        self.scale = [width, height, width, height]
+        self.names = names
+        self.tracks: dict[int, Track] = {}
+        self.writer = get_event_writer()
+
+    def _box(self, box):
+        # Normalized to 0-1, like regions
+        return [round(float(v) / s, 4) for v, s in zip(box, self.scale)]
+
+    def _emit(self, track_id: int, track: Track):
+        self.writer.put(
+            Event(
+                date=get_date(track.start),
+                type=EVENT_TYPE_OBJECT,
+                data={
+                    "camera": self.camera_id,
+                    "track": track_id,
+                    "class": self.names.get(track.class_id, str(track.class_id)),
+                    "class_id": track.class_id,
+                    "start": get_date(track.start).isoformat(),
+                    "end": get_date(track.end).isoformat(),
+                    "confidence": round(track.confidence, 4),
+                    "detections": track.count,
+                    "box": {
+                        "first": self._box(track.first_box),
+                        "last": self._box(track.last_box),
+                        "union": self._box(track.union_box),
+                    },
+                },
+            )
+        )
+
+    def motion(self, start: float, end: float, share: float):
+        # `share` is the most of the motion regions that moved at once
+        self.writer.put(
+            Event(
+                date=get_date(start),
+                type=EVENT_TYPE_MOTION,
+                data={
+                    "camera": self.camera_id,
+                    "start": get_date(start).isoformat(),
+                    "end": get_date(end).isoformat(),
+                    "share": round(share, 4),
+                },
+            )
+        )
+
+    def update(self, detections, now: float):
+        # `detections` are an inference's rows of x1, y1, x2, y2, confidence,
+        # class, track ID; `now` is a Unix time
+        for detection in detections:
+            track_id = int(detection[6])
+            track = self.tracks.get(track_id)
+            if track is None:
+                self.tracks[track_id] = Track(detection, now)
+                continue
+            track.update(detection, now)
+
+            # Objects that stay put still get recorded every so often
+            if track.end - track.start >= EVENT_DURATION_MAX:
+                self._emit(track_id, track)
+                del self.tracks[track_id]
+
+        self.expire(now)
+
+    def expire(self, now: float):
+        for track_id, track in list(self.tracks.items()):
+            if now - track.end > EVENT_TRACK_TIMEOUT:
+                self._emit(track_id, track)
+                del self.tracks[track_id]
+
+    def close(self):
+        for track_id, track in self.tracks.items():
+            self._emit(track_id, track)
+        self.tracks = {}
+        self.writer.flush()
@@ -4,3 +4,11 @@ class StallDetectedError(Exception):
 
 class OflowDetectedError(Exception):
     pass
+
+
+class StopRequestedError(Exception):
+    pass
+
+
+class StreamMismatchError(Exception):
+    pass
@@ -0,0 +1,102 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+FRAME_RING_EMPTY = -1
+
+_unclosed: list[SharedMemory] = []
+
+
+def close_shared_memory(shm: SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # Frames still in use elsewhere (e.g. by a model holding on to its
+        # last input) keep the mapping; closing is retried with the next ring
+        _unclosed.append(shm)
+        return False
+    return True
+
+
+class FrameRing:
+    def __init__(self, shape, num_slots: int, name: str | None = None):
+        self.shape = tuple(shape)
+        self.num_slots = num_slots
+        self.frame_size = int(np.prod(self.shape))
+
+        # Header: the latest committed sequence number, then the sequence
+        # number held by each slot
+        header_size = (num_slots + 1) * 8
+        self.owner = name is None
+        if self.owner:
+            self._shm = SharedMemory(
+                create=True, size=header_size + num_slots * self.frame_size
+            )
+        else:
+            self._shm = SharedMemory(name=name)
+            # Only the creating process may unlink the segment
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        self.name = self._shm.name
+
+        self._header = np.ndarray(num_slots + 1, np.int64, self._shm.buf)
+        self._frames = np.ndarray(
+            (num_slots, *self.shape), np.uint8, self._shm.buf, header_size
+        )
+        if self.owner:
+            self._header[:] = FRAME_RING_EMPTY
+
+        self._next = 0
+        self._index = 0
+        # Sequence numbers a reader in this process is still using
+        self.pinned: set[int] = set()
+
+    def latest(self):
+        return int(self._header[0])
+
+    def write_slot(self):
+        # Overwrites the oldest frame that isn't pinned, invalidating it first
+        # so that readers can't mistake a half-written frame for the one it
+        # replaces
+        sequences = self._header[1:]
+        candidates = [
+            index
+            for index in np.argsort(sequences, kind="stable")
+            if sequences[index] not in self.pinned
+        ]
+        self._index = int(candidates[0])
+        sequences[self._index] = FRAME_RING_EMPTY
+        return self._frames[self._index]
+
+    def commit(self):
+        sequence = self._next
+        self._header[self._index + 1] = sequence
+        self._header[0] = sequence
+        self._next += 1
+        return sequence
+
+    def _find(self, sequence: int):
+        if sequence < 0:
+            return None
+        indexes = np.flatnonzero(self._header[1:] == sequence)
+        return int(indexes[0]) if len(indexes) else None
+
+    def get(self, sequence: int):
+        # Views are only valid while valid() holds for the same sequence
+        index = self._find(sequence)
+        return None if index is None else self._frames[index]
+
+    def valid(self, sequence: int):
+        return self._find(sequence) is not None
+
+    def close(self):
+        self._header = self._frames = None
+        for shm in list(_unclosed):
+            if close_shared_memory(shm):
+                _unclosed.remove(shm)
+        close_shared_memory(self._shm)
+        if self.owner:
+            # Readers forked from this process share its resource tracker and
+            # may have unregistered the segment already
+            resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
@@ -0,0 +1,30 @@
+from signal import SIGINT, SIGTERM, signal
+from threading import Event
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from worker.management.commands.inference import (
+    InferenceServer,
+    load_inference_model,
+)
+
+
+class Command(BaseCommand):
+    help = "Runs the inference service shared by all camera workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", help="Defaults to INFERENCE_SOCKET")
+
+    def handle(self, *args, **options):
+        address = options["socket"] or settings.INFERENCE_SOCKET
+        if address is None:
+            raise CommandError("No inference socket configured")
+
+        stop = Event()
+        for s in (SIGINT, SIGTERM):
+            signal(s, lambda *_: stop.set())
+
+        server = InferenceServer(load_inference_model(), address)
+        server.serve(stop)
+        print(f"Served {server.frames} frames in {server.batches} batches.")
@@ -0,0 +1,203 @@
+from multiprocessing.connection import Client, Listener
+from os import remove
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import monotonic
+
+import numpy as np
+from django.conf import settings
+
+from worker.management.commands.constants import (
+    INFERENCE_BATCH_MAX,
+    INFERENCE_BATCH_WAIT,
+    INFERENCE_CHECK_PERIOD,
+    INFERENCE_WARMUP_SIZE,
+    YOLO_MODEL,
+)
+from worker.management.commands.detector import get_detector_threads, load_detector
+from worker.management.commands.framering import FrameRing
+from worker.management.commands.tracker import IoUTracker
+
+
+def load_inference_model(
+    backend: str | None = None, threads: int | None = None, int8: bool | None = None
+):
+    backend = backend or settings.DETECTOR_BACKEND
+    threads = threads or get_detector_threads(True)
+
+    print(f"Loading {YOLO_MODEL} for inference ({backend}, {threads} threads)...")
+    model = load_detector(backend, threads, int8)
+    frame = np.zeros([INFERENCE_WARMUP_SIZE, INFERENCE_WARMUP_SIZE, 3], np.uint8)
+    model.predict([frame])
+    print(f"Loaded {YOLO_MODEL}.", flush=True)
+
+    return model
+
+
+def get_label(names, confidence, class_id, track_id):
+    return f"{names.get(int(class_id), int(class_id))} {int(track_id)} {confidence:.2f}"
+
+
+def draw_detections(frame, detections, names):
+    import cv2
+
+    for x1, y1, x2, y2, confidence, class_id, track_id in detections:
+        top_left = int(x1), int(y1)
+        cv2.rectangle(frame, top_left, (int(x2), int(y2)), (0, 255, 0), 2)
+        cv2.putText(
+            frame,
+            get_label(names, confidence, class_id, track_id),
+            (top_left[0], max(top_left[1] - 4, 12)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 255, 0),
+        )
+    return frame
+
+
+class InferenceSession:
+    def __init__(self, conn, camera_id, frame_ring: FrameRing):
+        self.conn = conn
+        self.camera_id = camera_id
+        self.frame_ring = frame_ring
+        self.tracker = IoUTracker()
+        self.closed = False
+
+    def reply(self, detections):
+        if self.closed:
+            return
+        try:
+            self.conn.send(detections)
+        except OSError:
+            self.closed = True
+
+
+class InferenceServer:
+    def __init__(self, model, address: str):
+        self.model = model
+        self.address = address
+        self.requests: Queue[tuple[InferenceSession, int | None]] = Queue()
+
+        self.batches = 0
+        self.frames = 0
+
+    def serve(self, stop: Event):
+        try:
+            remove(self.address)
+        except FileNotFoundError:
+            pass
+        listener = Listener(self.address, "AF_UNIX")
+        Thread(target=self._accept, args=(listener,), daemon=True).start()
+        print(f"Serving inference on {self.address}...", flush=True)
+
+        try:
+            while not stop.is_set():
+                batch = self._next_batch()
+                if len(batch):
+                    self._run_batch(batch)
+        finally:
+            listener.close()
+
+    def _accept(self, listener: Listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                return
+            Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn):
+        # A session starts with the camera's frame ring, then carries one
+        # frame sequence number per request
+        try:
+            camera_id, ring_name, shape, num_slots = conn.recv()
+            frame_ring = FrameRing(shape, num_slots, ring_name)
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        session = InferenceSession(conn, camera_id, frame_ring)
+        print(f"{camera_id}: Inference session started.", flush=True)
+        try:
+            conn.send(self.model.names)
+            while True:
+                self.requests.put((session, conn.recv()))
+        except (EOFError, OSError):
+            pass
+
+        session.closed = True
+        self.requests.put((session, None))
+        conn.close()
+        print(f"{camera_id}: Inference session ended.", flush=True)
+
+    def _next_batch(self):
+        try:
+            batch = [self.requests.get(timeout=INFERENCE_CHECK_PERIOD)]
+        except Empty:
+            return []
+
+        # Wait a little for other cameras so the model runs once for all of
+        # them, but never past the first frame's deadline
+        deadline = monotonic() + INFERENCE_BATCH_WAIT
+        while len(batch) < INFERENCE_BATCH_MAX:
+            timeout = deadline - monotonic()
+            try:
+                batch.append(
+                    self.requests.get_nowait()
+                    if timeout <= 0
+                    else self.requests.get(timeout=timeout)
+                )
+            except Empty:
+                break
+        return batch
+
+    def _run_batch(self, batch):
+        # Rings of ended sessions are only closed here, once no frame of theirs
+        # is in use any more
+        ended = [session for session, sequence in batch if sequence is None]
+        valid = []
+        for session, sequence in batch:
+            if sequence is None or session.closed:
+                continue
+            if session.frame_ring.valid(sequence):
+                valid.append((session, sequence))
+            else:
+                # Overwritten while waiting; the camera still gets an answer
+                # and moves on to a newer frame
+                session.reply(None)
+        if len(valid):
+            self._predict_batch(valid)
+
+        for session in ended:
+            session.frame_ring.close()
+
+    def _predict_batch(self, batch):
+        frames = [session.frame_ring.get(sequence) for session, sequence in batch]
+        for (session, sequence), detections in zip(batch, self.model.predict(frames)):
+            # The frame may have been overwritten while the model was reading it
+            if not session.frame_ring.valid(sequence):
+                session.reply(None)
+                continue
+            session.reply(session.tracker.update(detections))
+
+        self.batches += 1
+        self.frames += len(frames)
+
+
+class InferenceClient:
+    def __init__(self, camera_id, frame_ring: FrameRing, address: str):
+        self.camera_id = camera_id
+        self.conn = Client(address, "AF_UNIX")
+        self.conn.send(
+            (camera_id, frame_ring.name, frame_ring.shape, frame_ring.num_slots)
+        )
+        self.names = self.conn.recv()
+
+    def track(self, sequence: int):
+        # Rows of x1, y1, x2, y2, confidence, class, track ID
+        self.conn.send(sequence)
+        detections = self.conn.recv()
+        return np.zeros((0, 7)) if detections is None else detections
+
+    def close(self):
+        self.conn.close()
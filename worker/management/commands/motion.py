@@ -0,0 +1,174 @@
+from math import ceil
+
+import numpy as np
+
+from worker.management.commands.constants import (
+    EVENT_DURATION_MAX,
+    MOTION_AREA_MAX,
+    MOTION_BACKGROUND_ALPHA,
+    MOTION_FRAME_SIZE_ALPHA,
+    MOTION_FRAME_SIZE_GATE,
+    MOTION_HOLD_SECS,
+    MOTION_PIXEL_THRESHOLD,
+    MOTION_SIZE_MAX,
+    MOTION_VECTOR_THRESHOLD,
+)
+
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], np.float32)
+
+
+def get_point(point):
+    if isinstance(point, dict):
+        return float(point["x"]), float(point["y"])
+    return float(point[0]), float(point[1])
+
+
+def rasterize_polygons(polygons, size):
+    # Polygons are lists of points normalized to 0-1; pixels are inside if
+    # their center is, by the even-odd rule
+    width, height = size
+    x = (np.arange(width, dtype=np.float32) + 0.5) / width
+    y = (np.arange(height, dtype=np.float32) + 0.5) / height
+    xs, ys = np.meshgrid(x, y)
+
+    mask = np.zeros((height, width), bool)
+    for polygon in polygons:
+        points = [get_point(point) for point in polygon]
+        inside = np.zeros((height, width), bool)
+        for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+            if y1 == y2:
+                continue
+            crosses = (ys >= min(y1, y2)) & (ys < max(y1, y2))
+            x_cross = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (xs < x_cross)
+        mask |= inside
+    return mask
+
+
+class MotionDetector:
+    def __init__(self, frame_shape, sensitivity: float, regions):
+        height, width = frame_shape[:2]
+        self.step = max(ceil(max(width, height) / MOTION_SIZE_MAX), 1)
+        size = ceil(width / self.step), ceil(height / self.step)
+
+        # Without regions, the whole frame counts
+        if len(regions):
+            self.mask = rasterize_polygons(regions, size)
+        else:
+            self.mask = np.ones(size[::-1], bool)
+
+        self.sensitivity = sensitivity
+        self.area = self.mask.sum()
+        self.area_min = max(self.area * MOTION_AREA_MAX * (1 - sensitivity), 1)
+
+        self.background = None
+        self.moving = 0
+
+    def update(self, frame):
+        # `frame` is RGB, of the shape given above
+        gray = frame[:: self.step, :: self.step] @ GRAY_WEIGHTS
+        if self.background is None:
+            self.background = gray
+            return False
+
+        difference = gray - self.background
+        self.moving = np.count_nonzero(
+            (np.abs(difference) > MOTION_PIXEL_THRESHOLD) & self.mask
+        )
+        self.background += difference * MOTION_BACKGROUND_ALPHA
+        return self.moving >= self.area_min
+
+    def share(self):
+        # Moving share of the regions
+        return float(self.moving / max(self.area, 1))
+
+
+class VectorMotionDetector(MotionDetector):
+    def __init__(self, frame_shape, sensitivity: float, regions):
+        super().__init__(frame_shape, sensitivity, regions)
+
+        # P-frames no bigger than those of the still scene have nothing moving
+        # in them; the more sensitive, the closer to that size they get looked at
+        self.size_gate = 1 + (MOTION_FRAME_SIZE_GATE - 1) * (1 - self.sensitivity)
+        self.still_size = None
+
+        # Frames since the last keyframe, and between the last two
+        self.since_keyframe = None
+        self.gop = None
+
+    def update(self, vectors, frame_size: int, keyframe: bool):
+        # `vectors` are the decoder's exported motion vectors, as a structured
+        # array, or None; `frame_size` is the frame's compressed size
+        if keyframe:
+            # Keyframes are big whatever the scene does, and have no vectors,
+            # so they keep the last result
+            if self.since_keyframe is not None:
+                self.gop = self.since_keyframe + 1
+            self.since_keyframe = 0
+            return self.moving >= self.area_min
+
+        # The first P-frame after a keyframe tends to come out bigger too
+        after_keyframe = self.since_keyframe == 0
+        if self.since_keyframe is not None:
+            self.since_keyframe += 1
+
+        if (
+            not after_keyframe
+            and self.still_size is not None
+            and frame_size <= self.still_size * self.size_gate
+        ):
+            self.moving = 0
+        elif vectors is not None:
+            self.moving = self._get_moving(vectors)
+        moving = self.moving >= self.area_min
+
+        if not moving and not after_keyframe:
+            if self.still_size is None:
+                self.still_size = frame_size
+            self.still_size += (frame_size - self.still_size) * MOTION_FRAME_SIZE_ALPHA
+        return moving
+
+    def _get_moving(self, vectors):
+        # Only count motion relative to past frames, so that blocks of
+        # B-frames aren't counted twice
+        vectors = vectors[vectors["source"] < 0]
+        magnitudes = np.hypot(vectors["motion_x"], vectors["motion_y"])
+        magnitudes /= np.maximum(vectors["motion_scale"], 1)
+        vectors = vectors[magnitudes > MOTION_VECTOR_THRESHOLD]
+
+        height, width = self.mask.shape
+        xs = np.clip(vectors["dst_x"] // self.step, 0, width - 1)
+        ys = np.clip(vectors["dst_y"] // self.step, 0, height - 1)
+        areas = vectors["w"].astype(np.float32) * vectors["h"] / self.step**2
+        return areas[self.mask[ys, xs]].sum()
+
+
+class MotionGate:
+    # Motion lasts until MOTION_HOLD_SECS after it was last detected, and
+    # each time it does ends up as an event
+    def __init__(self, event_collector):
+        self.event_collector = event_collector
+        self.start = None
+        self.end = 0
+        self.share = 0
+
+    def update(self, moving: bool, share: float, now: float):
+        if moving:
+            if self.start is None:
+                self.start = now
+            self.end = now
+            self.share = max(self.share, share)
+
+            # Motion that goes on still gets recorded every so often
+            if self.end - self.start >= EVENT_DURATION_MAX:
+                self.close()
+                self.start = now
+        elif self.start is not None and now >= self.end + MOTION_HOLD_SECS:
+            self.close()
+        return self.start is not None
+
+    def close(self):
+        if self.start is not None:
+            self.event_collector.motion(self.start, self.end, self.share)
+        self.start = None
+        self.share = 0
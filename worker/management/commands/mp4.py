@@ -0,0 +1,288 @@
+from struct import pack
+
+MP4_VIDEO_TIMESCALE = 90000
+MP4_VIDEO_TRACK_ID = 1
+MP4_AUDIO_TRACK_ID = 2
+MP4_AUDIO_WAIT_SECS = 10
+
+MP4_SAMPLE_FLAGS_SYNC = 0x02000000
+MP4_SAMPLE_FLAGS_NON_SYNC = 0x01010000
+
+MP4_MATRIX = pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+MP4_LANGUAGE_UND = 0x55C4
+
+TRUN_FLAGS = 0x000001 | 0x000100 | 0x000200 | 0x000400
+TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+
+
+def box(box_type: bytes, *payloads: bytes):
+    payload = b"".join(payloads)
+    return pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, *payloads: bytes):
+    return box(box_type, pack(">I", version << 24 | flags), *payloads)
+
+
+def descriptor(tag: int, *payloads: bytes):
+    payload = b"".join(payloads)
+    return pack(">BB", tag, len(payload)) + payload
+
+
+def ftyp():
+    return box(b"ftyp", b"isom", pack(">I", 0x200), b"isomiso5iso6avc1mp41")
+
+
+def mvhd(next_track_id: int):
+    return full_box(
+        b"mvhd",
+        0,
+        0,
+        pack(">IIII", 0, 0, 1000, 0),
+        pack(">IH10x", 0x10000, 0x100),
+        MP4_MATRIX,
+        bytes(24),
+        pack(">I", next_track_id),
+    )
+
+
+def tkhd(track_id: int, volume: int, width: int, height: int):
+    return full_box(
+        b"tkhd",
+        0,
+        0x3,
+        pack(">IIIII", 0, 0, track_id, 0, 0),
+        pack(">8xhhH2x", 0, 0, volume),
+        MP4_MATRIX,
+        pack(">II", width << 16, height << 16),
+    )
+
+
+def mdia(timescale: int, handler: bytes, name: bytes, minf: bytes):
+    return box(
+        b"mdia",
+        full_box(
+            b"mdhd", 0, 0, pack(">IIIIHH", 0, 0, timescale, 0, MP4_LANGUAGE_UND, 0)
+        ),
+        full_box(b"hdlr", 0, 0, pack(">I4s12x", 0, handler), name + b"\x00"),
+        minf,
+    )
+
+
+def minf(media_header: bytes, sample_entry: bytes):
+    return box(
+        b"minf",
+        media_header,
+        box(b"dinf", full_box(b"dref", 0, 0, pack(">I", 1), full_box(b"url ", 0, 1))),
+        box(
+            b"stbl",
+            full_box(b"stsd", 0, 0, pack(">I", 1), sample_entry),
+            full_box(b"stts", 0, 0, pack(">I", 0)),
+            full_box(b"stsc", 0, 0, pack(">I", 0)),
+            full_box(b"stsz", 0, 0, pack(">II", 0, 0)),
+            full_box(b"stco", 0, 0, pack(">I", 0)),
+        ),
+    )
+
+
+def avc1(width: int, height: int, sps: bytes, pps: bytes):
+    avcc = box(
+        b"avcC",
+        pack(">BBBBBB", 1, sps[1], sps[2], sps[3], 0xFF, 0xE1),
+        pack(">H", len(sps)),
+        sps,
+        pack(">BH", 1, len(pps)),
+        pps,
+    )
+    return box(
+        b"avc1",
+        pack(">6xH16xHH", 1, width, height),
+        pack(">IIIH", 0x480000, 0x480000, 0, 1),
+        bytes(32),
+        pack(">Hh", 0x18, -1),
+        avcc,
+    )
+
+
+def mp4a(sample_rate: int, channels: int, audio_specific_config: bytes):
+    esds = full_box(
+        b"esds",
+        0,
+        0,
+        descriptor(
+            0x03,
+            pack(">HB", 0, 0),
+            descriptor(
+                0x04,
+                pack(">BB3xII", 0x40, 0x15, 0, 0),
+                descriptor(0x05, audio_specific_config),
+            ),
+            descriptor(0x06, b"\x02"),
+        ),
+    )
+    return box(
+        b"mp4a",
+        pack(">6xH8x", 1),
+        pack(">HHHHI", channels, 16, 0, 0, sample_rate << 16),
+        esds,
+    )
+
+
+def traf(track_id: int, decode_time: int, samples, data_offset: int):
+    entries = b"".join(pack(">III", *sample) for sample in samples)
+    return box(
+        b"traf",
+        full_box(b"tfhd", 0, TFHD_DEFAULT_BASE_IS_MOOF, pack(">I", track_id)),
+        full_box(b"tfdt", 1, 0, pack(">Q", decode_time)),
+        full_box(
+            b"trun", 0, TRUN_FLAGS, pack(">Ii", len(samples), data_offset), entries
+        ),
+    )
+
+
+class FMP4Writer:
+    def __init__(self, path: str, frame_rate: float, size, has_audio: bool):
+        self.path = path
+        self.width, self.height = size
+        self.has_audio = has_audio
+        self.frame_duration = round(MP4_VIDEO_TIMESCALE / frame_rate)
+
+        self.sps: bytes | None = None
+        self.pps: bytes | None = None
+        self.audio_config = None
+
+        self._started = False
+        self._sequence = 0
+        self._video_samples: list[tuple[bytes, bool]] = []
+        self._video_time = 0
+        self._audio_samples: list[tuple[bytes, int]] = []
+        self._audio_time = 0
+
+    def pending_duration(self):
+        return len(self._video_samples) * self.frame_duration / MP4_VIDEO_TIMESCALE
+
+    def add_video_sample(self, data: bytes, keyframe: bool):
+        self._video_samples.append((data, keyframe))
+
+    def add_audio_sample(self, data: bytes, duration: int):
+        self._audio_samples.append((data, duration))
+
+    def _init_segment(self):
+        tracks = [
+            box(
+                b"trak",
+                tkhd(MP4_VIDEO_TRACK_ID, 0, self.width, self.height),
+                mdia(
+                    MP4_VIDEO_TIMESCALE,
+                    b"vide",
+                    b"VideoHandler",
+                    minf(
+                        full_box(b"vmhd", 0, 1, pack(">HHHH", 0, 0, 0, 0)),
+                        avc1(self.width, self.height, self.sps, self.pps),
+                    ),
+                ),
+            )
+        ]
+        if self.has_audio:
+            audio_specific_config, sample_rate, channels = self.audio_config
+            tracks.append(
+                box(
+                    b"trak",
+                    tkhd(MP4_AUDIO_TRACK_ID, 0x100, 0, 0),
+                    mdia(
+                        sample_rate,
+                        b"soun",
+                        b"SoundHandler",
+                        minf(
+                            full_box(b"smhd", 0, 0, pack(">hH", 0, 0)),
+                            mp4a(sample_rate, channels, audio_specific_config),
+                        ),
+                    ),
+                )
+            )
+
+        trexs = [
+            full_box(b"trex", 0, 0, pack(">IIIII", track_id, 1, 0, 0, 0))
+            for track_id in range(1, len(tracks) + 1)
+        ]
+        return ftyp() + box(
+            b"moov", mvhd(len(tracks) + 1), *tracks, box(b"mvex", *trexs)
+        )
+
+    def _fragment(self):
+        video_samples = [
+            (
+                self.frame_duration,
+                len(data),
+                MP4_SAMPLE_FLAGS_SYNC if keyframe else MP4_SAMPLE_FLAGS_NON_SYNC,
+            )
+            for data, keyframe in self._video_samples
+        ]
+        audio_samples = [
+            (duration, len(data), MP4_SAMPLE_FLAGS_SYNC)
+            for data, duration in self._audio_samples
+        ]
+        video_size = sum(size for _, size, _ in video_samples)
+
+        def moof(data_offset: int):
+            trafs = []
+            if len(video_samples):
+                trafs.append(
+                    traf(
+                        MP4_VIDEO_TRACK_ID, self._video_time, video_samples, data_offset
+                    )
+                )
+            if len(audio_samples):
+                trafs.append(
+                    traf(
+                        MP4_AUDIO_TRACK_ID,
+                        self._audio_time,
+                        audio_samples,
+                        data_offset + video_size,
+                    )
+                )
+            return box(
+                b"moof", full_box(b"mfhd", 0, 0, pack(">I", self._sequence)), *trafs
+            )
+
+        # Sample data offsets are relative to the start of the moof, whose size
+        # doesn't depend on the offsets themselves
+        data_offset = len(moof(0)) + 8
+        mdat = box(
+            b"mdat",
+            *(data for data, _ in self._video_samples),
+            *(data for data, _ in self._audio_samples),
+        )
+        return moof(data_offset) + mdat
+
+    def flush(self):
+        if not len(self._video_samples) and not len(self._audio_samples):
+            return 0
+        if not self._started:
+            if self.sps is None or self.pps is None:
+                return 0
+            if self.has_audio and self.audio_config is None:
+                # Give up on an audio stream that never shows up
+                if self.pending_duration() < MP4_AUDIO_WAIT_SECS:
+                    return 0
+                self.has_audio = False
+                self._audio_samples = []
+
+        self._sequence += 1
+        fragment = self._fragment()
+        # Fragments are appended about once a second, so reopening is cheap, and
+        # each one is complete on disk once written
+        with open(self.path, "ab" if self._started else "wb") as f:
+            if not self._started:
+                f.write(self._init_segment())
+            f.write(fragment)
+        self._started = True
+
+        self._video_time += len(self._video_samples) * self.frame_duration
+        self._audio_time += sum(duration for _, duration in self._audio_samples)
+        self._video_samples = []
+        self._audio_samples = []
+        return len(fragment)
+
+    def close(self):
+        self.flush()
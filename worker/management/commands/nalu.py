@@ -0,0 +1,245 @@
+from collections import deque
+
+from worker.management.commands.constants import CODEC_HEVC
+from worker.management.commands.ringbuffer import RingBuffer
+
+NALU_START_CODE = b"\x00\x00\x01"
+NALU_START_CODE_SIZE = len(NALU_START_CODE)
+
+H264_NALU_IDR = 5
+H264_NALU_SEI = 6
+H264_NALU_SPS = 7
+H264_NALU_PPS = 8
+H264_NALU_AUD = 9
+H264_NALU_VCL = range(1, 6)
+H264_NALU_AU_PREFIX = {H264_NALU_SEI, H264_NALU_SPS, H264_NALU_PPS, H264_NALU_AUD}
+
+H264_HIGH_PROFILES = {44, 83, 86, 100, 110, 118, 122, 128, 134, 135, 138, 139, 244}
+
+HEVC_NALU_IRAP = range(16, 24)
+HEVC_NALU_VPS = 32
+HEVC_NALU_SPS = 33
+HEVC_NALU_PPS = 34
+HEVC_NALU_AUD = 35
+HEVC_NALU_PREFIX_SEI = 39
+HEVC_NALU_VCL = range(32)
+HEVC_NALU_AU_PREFIX = {
+    HEVC_NALU_VPS,
+    HEVC_NALU_SPS,
+    HEVC_NALU_PPS,
+    HEVC_NALU_AUD,
+    HEVC_NALU_PREFIX_SEI,
+}
+
+
+def get_nalu_type(codec: str, header: int):
+    if codec == CODEC_HEVC:
+        return (header >> 1) & 0x3F
+    return header & 0x1F
+
+
+def is_keyframe(codec: str, nalu_type: int):
+    if codec == CODEC_HEVC:
+        return nalu_type in HEVC_NALU_IRAP
+    return nalu_type == H264_NALU_IDR
+
+
+class BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def bits(self, n: int):
+        value = 0
+        for _ in range(n):
+            byte = self.data[self.pos >> 3]
+            value = value << 1 | (byte >> (7 - (self.pos & 7))) & 1
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bits(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def skip_scaling_list(reader: BitReader, size: int):
+    last_scale, next_scale = 8, 8
+    for _ in range(size):
+        if next_scale:
+            next_scale = (last_scale + reader.se()) % 256
+        last_scale = next_scale or last_scale
+
+
+def get_sps_size(sps: bytes):
+    # `sps` is an H.264 SPS NAL unit, header byte included
+    reader = BitReader(sps[1:].replace(b"\x00\x00\x03", b"\x00\x00"))
+
+    profile_idc = reader.bits(8)
+    reader.bits(16)  # Constraint flags, level
+    reader.ue()  # seq_parameter_set_id
+
+    chroma_format_idc, separate_colour_plane = 1, 0
+    if profile_idc in H264_HIGH_PROFILES:
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = reader.bits(1)
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bits(1)  # qpprime_y_zero_transform_bypass_flag
+        if reader.bits(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.bits(1):
+                    skip_scaling_list(reader, 16 if i < 6 else 64)
+
+    reader.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()
+    elif pic_order_cnt_type == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bits(1)  # gaps_in_frame_num_value_allowed_flag
+
+    width = (reader.ue() + 1) * 16
+    height_units = reader.ue() + 1
+    frame_mbs_only = reader.bits(1)
+    height = height_units * 16 * (2 - frame_mbs_only)
+    if not frame_mbs_only:
+        reader.bits(1)
+    reader.bits(1)  # direct_8x8_inference_flag
+
+    if reader.bits(1):
+        left, right, top, bottom = (reader.ue() for _ in range(4))
+        if chroma_format_idc == 0 or separate_colour_plane:
+            crop_x, crop_y = 1, 2 - frame_mbs_only
+        else:
+            crop_x = 1 if chroma_format_idc == 3 else 2
+            crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+
+    return width, height
+
+
+class NALUScanner:
+    def __init__(self, codec: str, track_units: bool = False):
+        self.codec = codec
+        self.keyframes: deque[int] = deque()
+        self.scan_offset = 0
+
+        # Start offsets of every NAL unit and of its header byte
+        self.track_units = track_units
+        self.units: deque[tuple[int, int]] = deque()
+
+        if codec == CODEC_HEVC:
+            self._vcl_types, self._au_prefix_types = HEVC_NALU_VCL, HEVC_NALU_AU_PREFIX
+        else:
+            self._vcl_types, self._au_prefix_types = H264_NALU_VCL, H264_NALU_AU_PREFIX
+
+        self._au_start = None
+        self._last_vcl_keyframe = False
+
+        # Pictures seen so far, and how often bytes went by unscanned; frame
+        # numbers are only comparable while `skips` stays the same
+        self.frames = 0
+        self.skips = 0
+        self._keyframe_frames: dict[int, tuple[int, int]] = {}
+        self._header_size = 2 if codec == CODEC_HEVC else 1
+
+        # Latest complete H.264 SPS, header byte included
+        self.sps: bytes | None = None
+        self._sps_start = None
+
+    def scan(self, buffer: RingBuffer):
+        # Bytes that left the buffer without being scanned (e.g. spliced) can't
+        # hold a split point any more
+        if self.scan_offset < buffer.read_offset:
+            self.scan_offset = buffer.read_offset
+            self._au_start = None
+            self._sps_start = None
+            self.skips += 1
+        if self._sps_start is not None and self._sps_start < buffer.read_offset:
+            self._sps_start = None
+        start = self.scan_offset - buffer.read_offset
+
+        while True:
+            pos = buffer.find(NALU_START_CODE, start)
+            if pos == -1:
+                # The last bytes may be the beginning of a 4-byte start code
+                start = max(start, len(buffer) - NALU_START_CODE_SIZE)
+                break
+            header_pos = pos + NALU_START_CODE_SIZE
+            if header_pos + self._header_size >= len(buffer):
+                # The header and the byte after it (where a slice header
+                # starts) haven't arrived yet; keep a possible leading zero
+                # byte of a 4-byte start code unscanned too
+                start = max(pos - 1, 0)
+                break
+
+            unit_start = pos
+            if pos > 0 and buffer[pos - 1] == 0:
+                unit_start -= 1
+            if self._sps_start is not None:
+                self.sps = bytes(
+                    buffer[i]
+                    for i in range(self._sps_start - buffer.read_offset, unit_start)
+                )
+                self._sps_start = None
+
+            header = buffer[header_pos]
+            nalu_type = get_nalu_type(self.codec, header)
+            # first_mb_in_slice == 0, or first_slice_segment_in_pic_flag
+            first_slice = bool(buffer[header_pos + self._header_size] & 0x80)
+            unit_offset = buffer.read_offset + unit_start
+            if self.track_units:
+                self.units.append(
+                    (unit_offset, buffer.read_offset + pos + NALU_START_CODE_SIZE)
+                )
+            self._index(unit_offset, nalu_type, first_slice)
+            if self.codec != CODEC_HEVC and nalu_type == H264_NALU_SPS:
+                self._sps_start = buffer.read_offset + pos + NALU_START_CODE_SIZE
+
+            start = pos + NALU_START_CODE_SIZE
+
+        self.scan_offset = buffer.read_offset + start
+
+    def flush_offset(self):
+        # Parameter sets seen so far may still turn out to start a keyframe
+        if self._au_start is None:
+            return self.scan_offset
+        return min(self._au_start, self.scan_offset)
+
+    def _index(self, offset: int, nalu_type: int, first_slice: bool):
+        if nalu_type in self._au_prefix_types:
+            if self._au_start is None:
+                self._au_start = offset
+        elif nalu_type in self._vcl_types:
+            if first_slice:
+                self.frames += 1
+            keyframe = is_keyframe(self.codec, nalu_type)
+            if keyframe and (self._au_start is not None or not self._last_vcl_keyframe):
+                keyframe_offset = offset if self._au_start is None else self._au_start
+                self.keyframes.append(keyframe_offset)
+                self._keyframe_frames[keyframe_offset] = (self.frames - 1, self.skips)
+            self._au_start = None
+            self._last_vcl_keyframe = keyframe
+
+    def next_keyframe(self, offset: int):
+        while len(self.keyframes) and self.keyframes[0] < offset:
+            self._keyframe_frames.pop(self.keyframes.popleft(), None)
+        return self.keyframes[0] if len(self.keyframes) else None
+
+    def keyframe_frame(self, offset: int):
+        # The number of a still indexed keyframe's picture in the stream, and
+        # `skips` at the time
+        return self._keyframe_frames.get(offset)
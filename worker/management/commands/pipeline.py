@@ -1,69 +1,394 @@
+from queue import Empty, Full, Queue
+from threading import Condition, Thread
 from time import time
 
+from django.conf import settings
 import numpy as np
-from os import sched_getaffinity, sched_setaffinity
-from worker.management.commands.constants import YOLO_MODEL
+from worker.management.commands.constants import (
+    DETECT_ACTIVE_HOLD_SECS,
+    FRAME_RING_SLOTS,
+    MOTION_VECTOR_CHUNK_SIZE,
+    MOTION_VECTOR_QUEUE_SIZE,
+    PIPELINE_FRAME_TIMEOUT,
+    PIPELINE_STAT_PERIOD,
+    YOLO_MODEL,
+)
+from worker.management.commands.detector import get_detector_threads, load_detector
+from worker.management.commands.drawbox import DrawboxClient
+from worker.management.commands.events import EventCollector
+from worker.management.commands.framering import FRAME_RING_EMPTY, FrameRing
+from worker.management.commands.inference import (
+    InferenceClient,
+    draw_detections,
+)
+from worker.management.commands.motion import (
+    MotionDetector,
+    MotionGate,
+    VectorMotionDetector,
+)
+from worker.management.commands.tracker import BoxPropagator, IoUTracker
+from worker.management.commands.utils import get_detection_rates, get_motion_settings
 
 
 def load_model(camera_id, decode_size):
-    from ultralytics import YOLO
-
     decode_width, decode_height = decode_size
+    backend = settings.DETECTOR_BACKEND
 
-    print(f"{camera_id}: Loading YOLOv8 model...", flush=True)
-    model = YOLO(YOLO_MODEL)
-    frame = np.zeros([decode_height, decode_width, 3])
-    model.track(frame, half=True, verbose=False)
+    print(f"{camera_id}: Loading {YOLO_MODEL} ({backend})...", flush=True)
+    model = load_detector(backend, get_detector_threads(False))
+    frame = np.zeros([decode_height, decode_width, 3], np.uint8)
+    model.predict([frame])
     print(f"{camera_id}: Loaded {YOLO_MODEL}.")
 
-    print(f"{camera_id}: Setting CPU affinity...", flush=True)
-    cpus = list(sched_getaffinity(0))
-    affinity = {cpus[camera_id % len(cpus)]}
-    sched_setaffinity(0, affinity)
-    print(f"{camera_id}: Set affinity to {affinity}.")
+    return model
+
+
+class DetectionCadence:
+    def __init__(self, idle_rate: float, active_rate: float):
+        self.idle_rate = idle_rate
+        self.active_rate = active_rate
+        self.next_time = 0
+        self.active_until = 0
+
+    def rate(self, now: float):
+        return self.active_rate if now < self.active_until else self.idle_rate
+
+    def due(self, now: float):
+        return now >= self.next_time
+
+    def update(self, num_detections: int, now: float):
+        if num_detections:
+            self.active_until = now + DETECT_ACTIVE_HOLD_SECS
+        rate = self.rate(now)
+        self.next_time = now + 1 / rate if rate > 0 else now
+
+
+class FrameReader(Thread):
+    # Reads decoded frames into the ring as fast as ffmpeg produces them, so
+    # that slow detection drops frames instead of blocking ffmpeg, which also
+    # feeds the live stream and the recorder
+    def __init__(self, camera_id, ff_process, frame_ring: FrameRing, output=None):
+        super().__init__(name=f"{camera_id}-reader", daemon=True)
+        self.ff_process = ff_process
+        self.frame_ring = frame_ring
+        self.condition = Condition()
+        self.frames = 0
+        self.done = False
+
+        # Visualized frames are encoded by count, so every decoded frame goes
+        # out, with the latest boxes, whether or not it gets processed
+        self.output = output
+        self.detections = []
+        self.names = None
+
+    def run(self):
+        frame_size = self.frame_ring.frame_size
+        try:
+            while True:
+                with self.condition:
+                    if self.done:
+                        return
+                    slot = self.frame_ring.write_slot()
+                    slot_view = memoryview(slot).cast("B")
+
+                frame_pos = 0
+                while frame_pos < frame_size:
+                    in_bytes = self.ff_process.stdout.readinto(slot_view[frame_pos:])
+                    if not in_bytes:
+                        self.ff_process.terminate()
+                        break
+                    frame_pos += in_bytes
+                slot_view.release()
 
+                if frame_pos != frame_size:
+                    return
+                with self.condition:
+                    if self.done:
+                        return
+                    self.frame_ring.commit()
+                    self.frames += 1
+                    self.condition.notify()
 
-def run_pipeline(camera_id, decode_size, feature_config, ff_processes, model):
+                if self.output is not None:
+                    detections = self.detections
+                    if len(detections):
+                        slot = draw_detections(slot.copy(), detections, self.names)
+                    self.output.write(slot)
+                slot = None
+        finally:
+            self.stop()
+
+    def stop(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify()
+
+    def next_frame(self, last: int, timeout: float):
+        # The newest frame after `last`, pinned until released
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.done or self.frame_ring.latest() > last, timeout
+            )
+            sequence = self.frame_ring.latest()
+            if self.done or sequence <= last:
+                return None
+            self.frame_ring.pinned.add(sequence)
+            return sequence
+
+    def release(self, sequence: int):
+        with self.condition:
+            self.frame_ring.pinned.discard(sequence)
+
+
+def run_pipeline(
+    camera_id,
+    decode_size,
+    feature_config,
+    keyframes_only,
+    drawbox_config,
+    model,
+    inference_socket,
+    ff_processes,
+):
     decode_width, decode_height = decode_size
     detect_enabled, drawbox_enabled, drawtext_enabled = feature_config
 
     print()
     print(f"{camera_id}: Starting overlay loop...", flush=True)
 
-    frame_size = decode_width * decode_height * 3
-    frame_buffer = bytearray(frame_size)
+    # Decoded frames are read straight into shared memory, where any process
+    # attached to the ring can use them by sequence number
+    frame_ring = FrameRing((decode_height, decode_width, 3), FRAME_RING_SLOTS)
+    print(f"{camera_id}: - Frame ring: {frame_ring.name}")
+
+    # Without a model of its own, the camera uses the shared inference service
+    inference_client = None
+    if detect_enabled and model is None:
+        inference_client = InferenceClient(camera_id, frame_ring, inference_socket)
+        print(f"{camera_id}: - Inference service: {inference_socket}")
+
+    names = inference_client.names if inference_client is not None else None
+    tracker = None
+    if model is not None:
+        names = model.names
+        tracker = IoUTracker()
+
+    # Boxes drawn by ffmpeg on the full-size stream only need their
+    # coordinates sent over
+    drawbox_client = None
+    if drawbox_enabled and drawbox_config is not None:
+        drawbox_address, (width, height) = drawbox_config
+        drawbox_client = DrawboxClient(
+            drawbox_address, (width / decode_width, height / decode_height)
+        )
+        print(f"{camera_id}: - Drawbox commands: {drawbox_address}")
+
+    # Tracks end up as events once they're gone
+    event_collector = EventCollector(camera_id, decode_size, names)
+
+    # Inferences only run as often as the scene calls for, and keyframes are
+    # already as far apart as they need to be; boxes are carried along their
+    # tracks in between
+    detection_rates = (0, 0) if keyframes_only else get_detection_rates(camera_id)
+    cadence = DetectionCadence(*detection_rates)
+    propagator = BoxPropagator()
+    print(f"{camera_id}: - Detection rate: {cadence.idle_rate}-{cadence.active_rate}/s")
+
+    # With motion detection enabled, objects are only looked for while
+    # something moves in its regions
+    motion_detector, motion_gate = None, None
+    motion_enabled, sensitivity, regions = get_motion_settings(camera_id)
+    if motion_enabled:
+        motion_detector = MotionDetector(frame_ring.shape, sensitivity, regions)
+        motion_gate = MotionGate(event_collector)
+        print(f"{camera_id}: - Motion gating: {len(regions)} regions")
+
+    frame_output = None
+    if drawbox_enabled and drawbox_client is None:
+        frame_output = ff_processes[1].stdin
+    frame_reader = FrameReader(camera_id, ff_processes[0], frame_ring, frame_output)
+    frame_reader.names = names
+    frame_reader.start()
 
     counter = 0
-    frame_rate = 0
+    inferences = 0
+    dropped = 0
+    decoded = 0
+    sequence = FRAME_RING_EMPTY
     start = time()
 
-    while all(ff_process.poll() is None for ff_process in ff_processes):
-        frame_pos = 0
-        while frame_pos < frame_size:
-            frame_view = memoryview(frame_buffer)[frame_pos:]
-            in_bytes = ff_processes[0].stdout.readinto(frame_view)
-            if not in_bytes:
-                ff_processes[0].terminate()
-                break
-            frame_pos += in_bytes
+    try:
+        while all(ff_process.poll() is None for ff_process in ff_processes):
+            last_sequence = sequence
+            sequence = frame_reader.next_frame(last_sequence, PIPELINE_FRAME_TIMEOUT)
+            if sequence is None:
+                sequence = last_sequence
+                continue
+            dropped += sequence - last_sequence - 1
+            frame = frame_ring.get(sequence)
+
+            if detect_enabled:
+                now = time()
+                motion = True
+                if motion_detector is not None:
+                    moving = motion_detector.update(frame)
+                    motion = motion_gate.update(moving, motion_detector.share(), now)
+
+                if motion and cadence.due(now):
+                    if inference_client is not None:
+                        detections = inference_client.track(sequence)
+                    else:
+                        detections = tracker.update(model.predict([frame])[0])
+                    propagator.update(detections, now)
+                    cadence.update(len(detections), now)
+                    event_collector.update(detections, now)
+                    inferences += 1
+                else:
+                    # Nothing is looked for without motion, so nothing is shown
+                    if not motion:
+                        propagator.clear()
+                    detections = propagator.propagate(now)
+                    event_collector.expire(now)
+
+                if drawbox_client is not None:
+                    drawbox_client.draw(detections, names)
+                frame_reader.detections = detections
+
+            frame = None
+            frame_reader.release(sequence)
+
+            counter += 1
+            end = time()
+            if end - start >= PIPELINE_STAT_PERIOD:
+                decode_rate = (frame_reader.frames - decoded) / (end - start)
+                frame_rate = counter / (end - start)
+                interval = (end - start) / inferences if inferences else None
+                print(
+                    f"{camera_id}: {decode_rate} fps decoded, {frame_rate} fps processed, "
+                    f"dropped = {dropped}, detection interval = {interval}s"
+                )
+                counter = 0
+                inferences = 0
+                decoded = frame_reader.frames
+                start = end
+    finally:
+        frame_reader.stop()
+        if motion_gate is not None:
+            motion_gate.close()
+        event_collector.close()
+        if inference_client is not None:
+            inference_client.close()
+        if drawbox_client is not None:
+            drawbox_client.close()
+        frame = None
+        frame_ring.close()
+
+
+class ChunkReader(Thread):
+    # Reads the stream off ffmpeg as fast as it comes, so that a decoder
+    # falling behind drops data instead of holding up the recording
+    def __init__(self, camera_id, ff_process):
+        super().__init__(name=f"{camera_id}-reader", daemon=True)
+        self.ff_process = ff_process
+        self.chunks: Queue[bytes | None] = Queue(MOTION_VECTOR_QUEUE_SIZE)
+        self.dropped = 0
+
+    def run(self):
+        # None marks where chunks were dropped
+        gap = False
+        while True:
+            chunk = self.ff_process.stdout.read1(MOTION_VECTOR_CHUNK_SIZE)
+            if not chunk:
+                return
+            try:
+                if gap:
+                    self.chunks.put_nowait(None)
+                    gap = False
+                self.chunks.put_nowait(chunk)
+            except Full:
+                gap = True
+                self.dropped += 1
+
+
+def run_vector_pipeline(camera_id, stream_config, ff_processes):
+    import av
+
+    _, codec_name, size, _, _, _, _ = stream_config
+    width, height = size
+
+    _, sensitivity, regions = get_motion_settings(camera_id)
+    motion_detector = VectorMotionDetector((height, width), sensitivity, regions)
+    event_collector = EventCollector(camera_id, size, None)
+    motion_gate = MotionGate(event_collector)
+
+    print()
+    print(f"{camera_id}: Starting motion vector loop...", flush=True)
+
+    # The stream is copied out of the camera's ffmpeg, without a connection
+    # of its own. Motion vectors only come out of a decoder, but its frames
+    # are never converted and skip deblocking, which vectors don't need
+    def create_decoder():
+        codec_context = av.CodecContext.create(codec_name, "r")
+        codec_context.options = {"flags2": "+export_mvs", "skip_loop_filter": "all"}
+        return codec_context
+
+    codec_context = create_decoder()
+    chunk_reader = ChunkReader(camera_id, ff_processes[0])
+    chunk_reader.start()
+
+    counter = 0
+    motion = False
+    synced = True
+    start = time()
 
-        if frame_pos != frame_size:
-            continue
+    try:
+        while all(ff_process.poll() is None for ff_process in ff_processes):
+            try:
+                chunk = chunk_reader.chunks.get(timeout=PIPELINE_FRAME_TIMEOUT)
+            except Empty:
+                if not chunk_reader.is_alive():
+                    break
+                continue
 
-        frame = np.frombuffer(frame_buffer, np.uint8)
-        frame = frame.reshape([decode_height, decode_width, 3])
+            # After a gap, decoding starts over at the next keyframe
+            if chunk is None:
+                codec_context = create_decoder()
+                synced = False
+                continue
 
-        if detect_enabled:
-            results = model.track(frame, half=True, verbose=False)
+            for packet in codec_context.parse(chunk):
+                try:
+                    frames = codec_context.decode(packet)
+                except av.FFmpegError:
+                    continue
+                for frame in frames:
+                    synced = synced or frame.key_frame
+                    if not synced:
+                        continue
+                    side_data = frame.side_data.get("MOTION_VECTORS")
+                    vectors = side_data.to_ndarray() if side_data is not None else None
 
-            if drawbox_enabled:
-                frame = results[0].plot()
-                ff_processes[1].stdin.write(frame.tobytes())
+                    now = time()
+                    moving = motion_detector.update(
+                        vectors, packet.size, frame.key_frame
+                    )
+                    was_motion = motion
+                    motion = motion_gate.update(moving, motion_detector.share(), now)
+                    if motion and not was_motion:
+                        print(f"{camera_id}: Motion started.", flush=True)
+                    elif was_motion and not motion:
+                        print(f"{camera_id}: Motion stopped.", flush=True)
+                    counter += 1
 
-        counter += 1
-        if counter >= int(frame_rate) * 10:
             end = time()
-            frame_rate = counter / (end - start)
-            print(f"{camera_id}: {frame_rate} fps")
-            counter = 0
-            start = end
+            if end - start >= PIPELINE_STAT_PERIOD:
+                print(
+                    f"{camera_id}: {counter / (end - start)} fps, "
+                    f"dropped = {chunk_reader.dropped}, GOP = {motion_detector.gop}, "
+                    f"still size = {motion_detector.still_size}"
+                )
+                counter = 0
+                start = end
+    finally:
+        motion_gate.close()
+        event_collector.close()
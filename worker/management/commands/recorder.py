@@ -0,0 +1,298 @@
+import os
+from select import PIPE_BUF
+from struct import pack
+from subprocess import TimeoutExpired
+
+import ffmpeg
+from django.conf import settings
+
+from worker.management.commands.adts import (
+    ADTS_FRAME_SAMPLES,
+    ADTS_HEADER_SIZE,
+    get_adts_config,
+    get_adts_frame_size,
+    get_adts_frames_size,
+    get_adts_header_size,
+    is_adts_sync,
+)
+from worker.management.commands.constants import (
+    AUDIO_RATE,
+    CODEC_ADTS,
+    FF_GLOBAL_ARGS,
+    RAWAUDIO_SAMPLE_SIZE,
+    RECORD_FRAGMENT_SECS,
+    RECORD_MOVFLAGS,
+)
+from worker.management.commands.mp4 import FMP4Writer
+from worker.management.commands.nalu import (
+    H264_NALU_AU_PREFIX,
+    H264_NALU_AUD,
+    H264_NALU_IDR,
+    H264_NALU_PPS,
+    H264_NALU_SPS,
+    H264_NALU_VCL,
+    NALUScanner,
+)
+from worker.management.commands.relay import LazyFD, filter_fds
+from worker.management.commands.ringbuffer import RingBuffer
+from worker.management.commands.utils import mkfifotemp
+
+
+class FFmpegRecorder:
+    def __init__(
+        self,
+        file_path: str,
+        frame_rate: float,
+        hxxx_codec: str,
+        has_audio: bool,
+        rawaudio_codec: str,
+        rawaudio_params,
+        pipe_size: int,
+    ):
+        self.file_path = file_path
+        self.rawaudio_codec = rawaudio_codec
+        self._rawaudio_pending = 0
+
+        hxxx_out_path = mkfifotemp(hxxx_codec)
+        self.hxxx_out_fd = LazyFD(hxxx_out_path, os.O_WRONLY, "w", pipe_size)
+
+        rawaudio_out_path = mkfifotemp(rawaudio_codec)
+        self.rawaudio_out_fd = LazyFD(rawaudio_out_path, os.O_WRONLY, "w")
+
+        record_params = {
+            "movflags": RECORD_MOVFLAGS[settings.RECORD_FORMAT],
+            "vcodec": "copy",
+        }
+        if rawaudio_codec == CODEC_ADTS:
+            # ffmpeg's ADTS demuxer is called "aac"
+            rawaudio_params = {"f": "aac"}
+            record_params["acodec"] = "copy"
+            record_params["bsf:a"] = "aac_adtstoasc"
+        else:
+            record_params["ar"] = AUDIO_RATE
+            # The AAC encoder's priming packet starts before zero; shifting it
+            # would shift every video frame but the first, whose timestamp
+            # raw H.264 input leaves unset, so the recording would overlap the
+            # next one by a frame of audio
+            record_params["avoid_negative_ts"] = "disabled"
+
+        ffmpeg_inputs = [
+            ffmpeg.input(
+                hxxx_out_path,
+                framerate=frame_rate,
+                thread_queue_size=4194304,
+            )
+        ]
+        if has_audio:
+            ffmpeg_inputs.append(
+                ffmpeg.input(
+                    rawaudio_out_path,
+                    **rawaudio_params,
+                    thread_queue_size=262144,
+                )
+            )
+
+        record_cmd = (
+            ffmpeg.output(
+                *ffmpeg_inputs,
+                file_path,
+                **record_params,
+            )
+            .global_args(*FF_GLOBAL_ARGS)
+            .overwrite_output()
+        )
+        self.process = record_cmd.run_async()
+        self.pid = self.process.pid
+
+    def ready(self):
+        # Opens the video FIFO as soon as ffmpeg is waiting on it
+        return self.hxxx_out_fd.fileno() is not None
+
+    def wlist(self, hxxx_buffer: RingBuffer, rawaudio_buffer: RingBuffer):
+        _wlist = []
+        if len(hxxx_buffer):
+            _wlist.append(self.hxxx_out_fd)
+        if self._rawaudio_flush_size(rawaudio_buffer):
+            _wlist.append(self.rawaudio_out_fd)
+        return filter_fds(_wlist)
+
+    def write_hxxx(self, hxxx_buffer: RingBuffer, flush_to: int | None, wlist):
+        if self.hxxx_out_fd not in wlist:
+            return 0
+
+        num_bytes = self.hxxx_out_fd._fileio.write(hxxx_buffer.read_span(flush_to))
+        hxxx_buffer.consume(num_bytes)
+        return num_bytes
+
+    def _rawaudio_flush_size(self, rawaudio_buffer: RingBuffer):
+        # Only whole frames or samples, so that nothing is split across files
+        if self._rawaudio_pending:
+            return self._rawaudio_pending
+        if self.rawaudio_codec == CODEC_ADTS:
+            # Pipe writes of up to PIPE_BUF bytes are all-or-nothing
+            return get_adts_frames_size(rawaudio_buffer, PIPE_BUF)
+        return len(rawaudio_buffer) // RAWAUDIO_SAMPLE_SIZE * RAWAUDIO_SAMPLE_SIZE
+
+    def write_rawaudio(self, rawaudio_buffer: RingBuffer, wlist):
+        if self.rawaudio_out_fd not in wlist:
+            return 0
+
+        flush_to = self._rawaudio_flush_size(rawaudio_buffer)
+        num_bytes = self.rawaudio_out_fd._fileio.write(
+            rawaudio_buffer.read_span(flush_to)
+        )
+        rawaudio_buffer.consume(num_bytes)
+        self._rawaudio_pending = flush_to - num_bytes
+        return num_bytes
+
+    def close(self):
+        self.hxxx_out_fd.close()
+        self.rawaudio_out_fd.close()
+        self.process.terminate()
+
+    def done(self):
+        return self.process.poll() is not None
+
+    def stop(self):
+        self.hxxx_out_fd.close()
+        self.rawaudio_out_fd.close()
+
+        try:
+            self.process.wait(5)
+        except TimeoutExpired:
+            self.process.terminate()
+        try:
+            self.process.wait(5)
+        except TimeoutExpired:
+            self.process.kill()
+        self.process.wait()
+
+
+class NativeRecorder:
+    def __init__(
+        self,
+        file_path: str,
+        frame_rate: float,
+        size,
+        has_audio: bool,
+        hxxx_scanner: NALUScanner,
+    ):
+        self.file_path = file_path
+        self.hxxx_scanner = hxxx_scanner
+
+        self.writer = FMP4Writer(file_path, frame_rate, size, has_audio)
+
+        self._access_unit: list[bytes] = []
+        self._has_vcl = False
+        self._keyframe = False
+        self._started = False
+
+    def inherit(self, previous: "NativeRecorder | None"):
+        # Parameter sets are usually only sent once per stream
+        if previous is not None:
+            self.writer.sps = previous.writer.sps
+            self.writer.pps = previous.writer.pps
+            self.writer.audio_config = previous.writer.audio_config
+
+    def ready(self):
+        return True
+
+    def wlist(self, hxxx_buffer: RingBuffer, rawaudio_buffer: RingBuffer):
+        return []
+
+    def write_hxxx(self, hxxx_buffer: RingBuffer, flush_to: int | None, wlist):
+        if flush_to is None:
+            flush_to = len(hxxx_buffer)
+        end_offset = hxxx_buffer.read_offset + flush_to
+        start_offset = hxxx_buffer.read_offset
+
+        units = self.hxxx_scanner.units
+        if not len(units):
+            # Nothing that looks like a NAL unit yet
+            hxxx_buffer.consume(
+                max(min(self.hxxx_scanner.scan_offset, end_offset) - start_offset, 0)
+            )
+
+        # A unit is complete once the start of the next one is known
+        while len(units) >= 2 and units[1][0] <= end_offset:
+            _, payload_offset = units.popleft()
+            hxxx_buffer.consume(payload_offset - hxxx_buffer.read_offset)
+            self._add_nalu(hxxx_buffer.read(units[0][0] - payload_offset))
+
+        if len(units) and units[0][0] > hxxx_buffer.read_offset:
+            hxxx_buffer.consume(min(units[0][0], end_offset) - hxxx_buffer.read_offset)
+
+        return hxxx_buffer.read_offset - start_offset
+
+    def _add_nalu(self, nalu: bytes):
+        if not len(nalu):
+            return
+
+        nalu_type = nalu[0] & 0x1F
+        first_slice = nalu_type in H264_NALU_VCL and len(nalu) > 1 and nalu[1] & 0x80
+        if self._has_vcl and (nalu_type in H264_NALU_AU_PREFIX or first_slice):
+            self._add_access_unit()
+
+        if nalu_type == H264_NALU_SPS:
+            self.writer.sps = nalu
+        elif nalu_type == H264_NALU_PPS:
+            self.writer.pps = nalu
+        elif nalu_type == H264_NALU_AUD:
+            return
+        elif nalu_type in H264_NALU_VCL:
+            self._has_vcl = True
+            if nalu_type == H264_NALU_IDR:
+                # Frames before the first keyframe can't be decoded
+                self._keyframe = self._started = True
+
+        self._access_unit.append(pack(">I", len(nalu)) + nalu)
+
+    def _add_access_unit(self):
+        if self._started:
+            if self._keyframe or self.writer.pending_duration() >= RECORD_FRAGMENT_SECS:
+                self.writer.flush()
+            self.writer.add_video_sample(b"".join(self._access_unit), self._keyframe)
+
+        self._access_unit = []
+        self._has_vcl = False
+        self._keyframe = False
+
+    def write_rawaudio(self, rawaudio_buffer: RingBuffer, wlist):
+        num_bytes = 0
+
+        while len(rawaudio_buffer) >= ADTS_HEADER_SIZE:
+            header = rawaudio_buffer.peek(ADTS_HEADER_SIZE)
+            if not is_adts_sync(header):
+                rawaudio_buffer.consume(1)
+                num_bytes += 1
+                continue
+
+            frame_size = get_adts_frame_size(header)
+            header_size = get_adts_header_size(header)
+            if frame_size <= header_size:
+                rawaudio_buffer.consume(1)
+                num_bytes += 1
+                continue
+            if len(rawaudio_buffer) < frame_size:
+                break
+
+            frame = rawaudio_buffer.read(frame_size)
+            num_bytes += frame_size
+
+            if self.writer.audio_config is None:
+                self.writer.audio_config = get_adts_config(header)
+            if self._started:
+                self.writer.add_audio_sample(frame[header_size:], ADTS_FRAME_SAMPLES)
+
+        return num_bytes
+
+    def close(self):
+        if self._has_vcl:
+            self._add_access_unit()
+        self.writer.close()
+
+    def done(self):
+        return True
+
+    def stop(self):
+        self.close()
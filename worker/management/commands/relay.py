@@ -0,0 +1,119 @@
+import os
+from errno import EBADF, ENOENT, ENXIO
+from fcntl import F_SETPIPE_SZ, fcntl
+from io import FileIO
+from select import EPOLLERR, EPOLLHUP, EPOLLIN, EPOLLOUT, epoll, select
+
+
+class LazyFD:
+    def __init__(self, path: str, flags: int, mode: str, pipe_size: int = 0):
+        self.path = path
+        self.flags = flags
+        self.mode = mode
+        self.pipe_size = pipe_size
+        self._fileio: FileIO | None = None
+
+    def close(self):
+        if self._fileio is not None:
+            self._fileio.close()
+            self._fileio = None
+
+    def fileno(self):
+        if self._fileio is None:
+            try:
+                self._fileio = FileIO(
+                    os.open(self.path, self.flags | os.O_NONBLOCK),
+                    self.mode,
+                )
+                os.set_blocking(self._fileio.fileno(), False)
+            except OSError as e:
+                if e.errno != ENXIO:
+                    raise
+            else:
+                if self.pipe_size:
+                    set_pipe_size(self._fileio.fileno(), self.pipe_size)
+        return self._fileio and self._fileio.fileno()
+
+
+def filter_fds(fds: list[LazyFD]):
+    return [fd for fd in fds if fd.fileno() is not None]
+
+
+def set_pipe_size(fd: int, size: int):
+    # Unprivileged processes are capped at /proc/sys/fs/pipe-max-size
+    try:
+        fcntl(fd, F_SETPIPE_SZ, size)
+    except PermissionError:
+        pass
+
+
+def splice_fds(in_fd: LazyFD, out_fd: LazyFD, count: int):
+    if out_fd.fileno() is None:
+        return None
+    try:
+        return os.splice(
+            in_fd.fileno(),
+            out_fd.fileno(),
+            count,
+            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+        )
+    except BlockingIOError:
+        return None
+
+
+class SelectPoller:
+    def poll(self, rlist: list[LazyFD], wlist: list[LazyFD], timeout: float):
+        rlist, wlist, _ = select(rlist, wlist, [], timeout)
+        return rlist, wlist
+
+    def close(self):
+        pass
+
+
+class EpollPoller:
+    def __init__(self):
+        self._epoll = epoll()
+        self._registered: dict[int, tuple[int, FileIO]] = {}
+
+    def _unregister(self, fileno: int):
+        del self._registered[fileno]
+        try:
+            self._epoll.unregister(fileno)
+        except OSError as e:
+            # Already dropped by the kernel when the file was closed
+            if e.errno not in (EBADF, ENOENT):
+                raise
+
+    def poll(self, rlist: list[LazyFD], wlist: list[LazyFD], timeout: float):
+        wanted: dict[int, tuple[int, FileIO]] = {}
+        fds: dict[int, LazyFD] = {}
+        requests = [(fd, EPOLLIN) for fd in rlist] + [(fd, EPOLLOUT) for fd in wlist]
+        for fd, mask in requests:
+            fileno = fd.fileno()
+            prev_mask, _ = wanted.get(fileno, (0, None))
+            wanted[fileno] = prev_mask | mask, fd._fileio
+            fds[fileno] = fd
+
+        for fileno, (_, fileio) in list(self._registered.items()):
+            if fileno not in wanted or wanted[fileno][1] is not fileio:
+                self._unregister(fileno)
+
+        for fileno, (mask, fileio) in wanted.items():
+            if fileno not in self._registered:
+                self._epoll.register(fileno, mask)
+            elif self._registered[fileno][0] != mask:
+                self._epoll.modify(fileno, mask)
+            self._registered[fileno] = mask, fileio
+
+        rready, wready = [], []
+        for fileno, events in self._epoll.poll(timeout):
+            mask, _ = self._registered[fileno]
+            if mask & EPOLLIN and events & (EPOLLIN | EPOLLHUP | EPOLLERR):
+                rready.append(fds[fileno])
+            if mask & EPOLLOUT and events & (EPOLLOUT | EPOLLERR):
+                wready.append(fds[fileno])
+        return rready, wready
+
+    def close(self):
+        self._epoll.close()
+        self._registered = {}
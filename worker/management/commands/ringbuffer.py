@@ -0,0 +1,109 @@
+from mmap import PAGESIZE, mmap
+from tempfile import TemporaryFile
+
+
+class RingBuffer:
+    def __init__(self, capacity: int, buffer=None):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity) if buffer is None else buffer
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._size = 0
+
+        # Absolute stream positions of the first buffered byte and the byte
+        # after the last buffered byte
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index: int):
+        return self._buffer[(self._start + index) % self.capacity]
+
+    def free(self):
+        return self.capacity - self._size
+
+    def write_span(self):
+        if self._size == 0:
+            self._start = 0
+        end = (self._start + self._size) % self.capacity
+        if self._size == self.capacity:
+            return self._view[0:0]
+        if end < self._start:
+            return self._view[end : self._start]
+        return self._view[end:]
+
+    def commit(self, num_bytes: int):
+        self._size += num_bytes
+        self.write_offset += num_bytes
+
+    def read_span(self, limit: int | None = None):
+        end = min(self._start + self._size, self.capacity)
+        if limit is not None:
+            end = min(end, self._start + limit)
+        return self._view[self._start : end]
+
+    def consume(self, num_bytes: int):
+        self._start = (self._start + num_bytes) % self.capacity
+        self._size -= num_bytes
+        self.read_offset += num_bytes
+
+    def peek(self, num_bytes: int):
+        num_bytes = min(num_bytes, self._size)
+        head = self.read_span(num_bytes)
+        if len(head) == num_bytes:
+            return bytes(head)
+        return bytes(head) + bytes(self._view[: num_bytes - len(head)])
+
+    def read(self, num_bytes: int):
+        data = self.peek(num_bytes)
+        self.consume(len(data))
+        return data
+
+    def find(self, sub: bytes, start: int = 0, end: int | None = None):
+        end = self._size if end is None else min(end, self._size)
+        phys_start = self._start + start
+        phys_end = self._start + end
+
+        if phys_start >= self.capacity:
+            pos = self._buffer.find(
+                sub, phys_start - self.capacity, phys_end - self.capacity
+            )
+            return pos if pos == -1 else pos + self.capacity - self._start
+        if phys_end <= self.capacity:
+            pos = self._buffer.find(sub, phys_start, phys_end)
+            return pos if pos == -1 else pos - self._start
+
+        pos = self._buffer.find(sub, phys_start, self.capacity)
+        if pos != -1:
+            return pos - self._start
+
+        phys_end -= self.capacity
+        overlap = len(sub) - 1
+        seam_start = max(phys_start, self.capacity - overlap)
+        seam = bytes(self._view[seam_start:]) + bytes(
+            self._view[: min(phys_end, overlap)]
+        )
+        pos = seam.find(sub)
+        if pos != -1:
+            return seam_start - self._start + pos
+
+        pos = self._buffer.find(sub, 0, phys_end)
+        return pos if pos == -1 else pos + self.capacity - self._start
+
+
+class SpillBuffer(RingBuffer):
+    def __init__(self, capacity: int, directory: str | None = None):
+        capacity = -(-capacity // PAGESIZE) * PAGESIZE
+
+        # Unlinked on creation, so nothing is left behind after a crash; the
+        # mapping keeps its own descriptor once the file is closed
+        with TemporaryFile(dir=directory) as f:
+            f.truncate(capacity)
+            buffer = mmap(f.fileno(), capacity)
+        super().__init__(capacity, buffer)
+
+    def close(self):
+        self._view.release()
+        self._buffer.close()
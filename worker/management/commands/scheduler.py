@@ -0,0 +1,372 @@
+import json
+from fcntl import LOCK_EX, flock
+from glob import glob
+from math import ceil
+from os import getpid, kill, listdir, sched_getaffinity, sched_setaffinity, sysconf
+from tempfile import gettempdir
+from threading import Lock, Thread, get_native_id
+from time import monotonic, sleep, time
+
+from django.conf import settings
+
+from worker.management.commands.constants import (
+    ENCODER_BOARD,
+    SCHEDULER_BOARD,
+    SCHEDULER_LOAD_CHANGE,
+    SCHEDULER_LOAD_DEFAULT,
+    SCHEDULER_PERIOD,
+    SCHEDULER_STALE_SECS,
+    X264_THREADS_MAX,
+    X264_TIERS,
+)
+
+CLOCK_TICKS = sysconf("SC_CLK_TCK")
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def read_cpu_list(text: str):
+    # e.g. "0-3,8-11"
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_topology():
+    # NUMA nodes, as lists of physical cores, as tuples of their SMT siblings;
+    # only CPUs this process may run on count
+    allowed = sched_getaffinity(0)
+    nodes = {}
+    for cpu in sorted(allowed):
+        base = f"/sys/devices/system/cpu/cpu{cpu}"
+        try:
+            with open(f"{base}/topology/thread_siblings_list") as f:
+                siblings = read_cpu_list(f.read())
+        except OSError:
+            siblings = [cpu]
+        node_dirs = glob(f"{base}/node[0-9]*")
+        node = int(node_dirs[0].rsplit("node", 1)[1]) if len(node_dirs) else 0
+        core = tuple(sibling for sibling in siblings if sibling in allowed)
+        nodes.setdefault(node, set()).add(core)
+    return [sorted(cores) for _, cores in sorted(nodes.items())]
+
+
+def assign_cpus(topology, loads):
+    # Busiest cameras first, each on the least loaded node, on as many whole
+    # cores as its load needs; cores are shared once there are too few
+    core_loads = {core: 0.0 for node in topology for core in node}
+    assignment = {}
+    for camera_id, load in sorted(loads.items(), key=lambda item: (-item[1], item[0])):
+        node = min(
+            topology, key=lambda node: sum(core_loads[c] for c in node) / len(node)
+        )
+        num_cores = min(max(ceil(load), 1), len(node))
+        cores = sorted(node, key=lambda core: core_loads[core])[:num_cores]
+        for core in cores:
+            core_loads[core] += load / num_cores
+        assignment[camera_id] = sorted(cpu for core in cores for cpu in core)
+    return assignment
+
+
+def read_cpu_time(path: str):
+    with open(path) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def pid_alive(pid: int):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def exchange_board(name: str, update):
+    # Boards are shared by all worker processes on the host; `update` gets
+    # to change one, without the entries of processes that are gone, while
+    # it's locked
+    with open(f"{gettempdir()}/{name}", "a+") as f:
+        flock(f, LOCK_EX)
+        f.seek(0)
+        try:
+            board = json.loads(f.read() or "{}")
+        except ValueError:
+            board = {}
+
+        board = {key: entry for key, entry in board.items() if pid_alive(entry["pid"])}
+        update(board)
+
+        f.seek(0)
+        f.truncate()
+        json.dump(board, f)
+    return board
+
+
+class CameraTasks:
+    def __init__(self):
+        # Processes count with all their threads; threads are this process's
+        self.tasks = {}  # (kind, ID) -> component
+        self.cpu_times = {}
+        self.loads = {}  # Component -> cores
+        self.published = SCHEDULER_LOAD_DEFAULT
+        self.cpus = None
+
+    def measure(self, elapsed: float):
+        loads = {}
+        for (kind, task_id), component in list(self.tasks.items()):
+            path = f"/proc/{task_id}/stat"
+            if kind == "thread":
+                path = f"/proc/self/task/{task_id}/stat"
+            try:
+                cpu_time = read_cpu_time(path)
+            except OSError:
+                del self.tasks[(kind, task_id)]
+                self.cpu_times.pop((kind, task_id), None)
+                continue
+            last = self.cpu_times.get((kind, task_id))
+            self.cpu_times[(kind, task_id)] = cpu_time
+            if last is not None and elapsed > 0:
+                loads[component] = loads.get(component, 0) + (cpu_time - last) / elapsed
+        if len(loads):
+            self.loads = loads
+
+    def load(self):
+        # Only moves once it changes enough, so that cameras don't keep
+        # getting reshuffled
+        load = sum(self.loads.values()) if len(self.loads) else self.published
+        if abs(load - self.published) > SCHEDULER_LOAD_CHANGE * max(self.published, 1):
+            self.published = load
+        return self.published
+
+    def apply(self):
+        for kind, task_id in list(self.tasks):
+            tids = [task_id]
+            if kind == "process":
+                try:
+                    tids = [int(tid) for tid in listdir(f"/proc/{task_id}/task")]
+                except OSError:
+                    continue
+            for tid in tids:
+                try:
+                    sched_setaffinity(tid, self.cpus)
+                except OSError:
+                    pass
+
+
+class CpuScheduler:
+    # Cameras of every worker process on this host share one board, from
+    # which each process works out the same assignment and applies its part
+    def __init__(self):
+        self.topology = get_topology()
+        self.cameras: dict[int, CameraTasks] = {}
+        self.lock = Lock()
+        self.last_update = monotonic()
+
+        print(
+            f"CPU topology: {len(self.topology)} nodes, "
+            f"{sum(len(node) for node in self.topology)} cores",
+            flush=True,
+        )
+        Thread(target=self._run, name="cpu-scheduler", daemon=True).start()
+
+    def attach(self, camera_id, component: str, pids=(), tids=()):
+        with self.lock:
+            camera = self.cameras.setdefault(camera_id, CameraTasks())
+            for pid in pids:
+                camera.tasks[("process", pid)] = component
+            for tid in tids:
+                camera.tasks[("thread", tid)] = component
+        self.update()
+
+    def detach(self, camera_id, pids=(), tids=()):
+        with self.lock:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                return
+            for task in [("process", pid) for pid in pids] + [
+                ("thread", tid) for tid in tids
+            ]:
+                camera.tasks.pop(task, None)
+                camera.cpu_times.pop(task, None)
+
+    def remove(self, camera_id):
+        with self.lock:
+            self.cameras.pop(camera_id, None)
+        self.update()
+
+    def _run(self):
+        while True:
+            sleep(SCHEDULER_PERIOD)
+            self.update(True)
+
+    def _exchange(self, loads):
+        def update(board):
+            now = time()
+            for camera_id, entry in list(board.items()):
+                if (
+                    entry["pid"] == getpid()
+                    or now - entry["time"] >= SCHEDULER_STALE_SECS
+                ):
+                    del board[camera_id]
+            for camera_id, load in loads.items():
+                board[str(camera_id)] = {"pid": getpid(), "load": load, "time": now}
+
+        board = exchange_board(SCHEDULER_BOARD, update)
+        return {int(camera_id): entry["load"] for camera_id, entry in board.items()}
+
+    def update(self, measure: bool = False):
+        # Loads are only measured periodically; cameras coming and going just
+        # get them redistributed
+        with self.lock:
+            if measure:
+                now = monotonic()
+                for camera in self.cameras.values():
+                    camera.measure(now - self.last_update)
+                self.last_update = now
+
+            loads = {
+                camera_id: camera.load() for camera_id, camera in self.cameras.items()
+            }
+            assignment = assign_cpus(self.topology, self._exchange(loads))
+
+            for camera_id, camera in self.cameras.items():
+                cpus = assignment[camera_id]
+                if cpus != camera.cpus:
+                    components = ", ".join(
+                        f"{component} {load:.2f}"
+                        for component, load in sorted(camera.loads.items())
+                    )
+                    print(
+                        f"{camera_id}: CPUs {cpus} for a load of "
+                        f"{loads[camera_id]:.2f} cores ({components or 'not measured'})",
+                        flush=True,
+                    )
+                    camera.cpus = cpus
+                camera.apply()
+
+
+def get_scheduler():
+    global _scheduler
+    if not settings.CPU_SCHEDULER:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = CpuScheduler()
+    return _scheduler
+
+
+def run_attached(camera_id, component: str, func, *args):
+    # Runs `func` on the calling thread, scheduled along with the camera
+    scheduler = get_scheduler()
+    if scheduler is None:
+        return func(*args)
+
+    tid = get_native_id()
+    scheduler.attach(camera_id, component, tids=[tid])
+    try:
+        return func(*args)
+    finally:
+        scheduler.detach(camera_id, tids=[tid])
+
+
+def get_encoder_budget():
+    return settings.ENCODER_THREADS or len(sched_getaffinity(0))
+
+
+def share_encoder_threads(pixel_rates, budget: int):
+    # Whole threads in proportion to the cameras' pixel rates, adding up to the
+    # budget; every camera gets at least one, and ties go to the lowest ID
+    total = sum(pixel_rates.values())
+    ideals = {
+        camera_id: budget * pixel_rate / total if total else 0
+        for camera_id, pixel_rate in pixel_rates.items()
+    }
+    shares = {
+        camera_id: min(max(int(ideal), 1), X264_THREADS_MAX)
+        for camera_id, ideal in ideals.items()
+    }
+    remaining = budget - sum(shares.values())
+    while remaining > 0:
+        candidates = [c for c, share in shares.items() if share < X264_THREADS_MAX]
+        if not len(candidates):
+            break
+        camera_id = min(candidates, key=lambda c: (shares[c] - ideals[c], c))
+        shares[camera_id] += 1
+        remaining -= 1
+    return shares
+
+
+def get_x264_params(camera_id, size, frame_rate: float):
+    # Transcoding cameras share the host's encoder threads in proportion to
+    # their pixel rates. A camera's share is set once, when its encoder starts:
+    # it only takes what the others have left, and cameras that are reserved
+    # but haven't started yet count as much as an average one
+    width, height = size
+    pixel_rate = width * height * frame_rate
+    budget = get_encoder_budget()
+    threads = 1
+
+    def update(board):
+        nonlocal threads
+        board.pop(str(camera_id), None)
+        pixel_rates = {
+            int(key): entry["pixel_rate"]
+            for key, entry in board.items()
+            if entry["pixel_rate"] is not None
+        }
+        pixel_rates[camera_id] = pixel_rate
+        average = sum(pixel_rates.values()) / len(pixel_rates)
+        for key in board:
+            pixel_rates.setdefault(int(key), average)
+
+        shares = share_encoder_threads(pixel_rates, budget)
+        taken = sum(entry["threads"] for entry in board.values())
+        threads = max(min(shares[camera_id], budget - taken), 1)
+        board[str(camera_id)] = {
+            "pid": getpid(),
+            "pixel_rate": pixel_rate,
+            "threads": threads,
+        }
+
+    exchange_board(ENCODER_BOARD, update)
+
+    # Fewer threads per pixel call for a faster preset
+    for rate_max, preset, lookahead in X264_TIERS:
+        if rate_max is None or pixel_rate / threads <= rate_max:
+            break
+    return threads, preset, lookahead
+
+
+def reserve_encoder_threads(camera_ids):
+    # Cameras about to start hold a place in the shares, so that the first ones
+    # to start don't take the whole budget; copy and hardware encoders release
+    # theirs as soon as they know
+    def update(board):
+        for camera_id in camera_ids:
+            board.setdefault(
+                str(camera_id), {"pid": getpid(), "pixel_rate": None, "threads": 0}
+            )
+
+    exchange_board(ENCODER_BOARD, update)
+
+
+def release_encoder_threads(camera_id, restarting: bool = False):
+    # A camera that's restarting keeps its place and pixel rate, but not its
+    # threads, so it gets the same share back
+    def update(board):
+        entry = board.get(str(camera_id))
+        if restarting and entry is not None:
+            entry["threads"] = 0
+        else:
+            board.pop(str(camera_id), None)
+
+    exchange_board(ENCODER_BOARD, update)
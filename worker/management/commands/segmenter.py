@@ -1,11 +1,8 @@
 from datetime import timedelta
-from errno import ENXIO
-from io import FileIO
 import os
 from pathlib import Path
 from random import randrange
-from select import select
-from subprocess import TimeoutExpired
+from threading import Event, Thread
 from time import perf_counter
 from traceback import print_exception
 
@@ -16,85 +13,188 @@ import ffmpeg
 from camera.models import Camera
 from storage.models import Video
 from worker.management.commands.constants import (
-    AUDIO_RATE,
-    CODEC_RAWAUDIO,
-    FF_GLOBAL_ARGS,
-    HXXX_NALU_HEADER,
-    HXXX_NALU_HEADER_SIZE,
-    HXXX_OFLOW,
+    HXXX_BUFFER_SIZE,
     OFLOW_PERIOD_MAX,
-    RAWAUDIO_OFLOW,
-    RAWAUDIO_SAMPLE_SIZE,
+    RAWAUDIO_BUFFER_SIZE,
     READ_MAX_SIZE,
+    RECORD_MUXER_NATIVE,
+    RECORD_PREWARM_SECS,
+    RELAY_PIPE_SIZE,
+    RELAY_SPLICE,
+    SPILL_SECS,
     STALL_PERIOD_MAX,
     STAT_CHECK_PERIOD,
 )
-from worker.management.commands.exceptions import OflowDetectedError, StallDetectedError
-from worker.management.commands.utils import mkfifotemp
-
-
-class LazyFD:
-    def __init__(self, path: str, flags: int, mode: str):
-        self.path = path
-        self.flags = flags
-        self.mode = mode
-        self._fileio: FileIO | None = None
-
-    def close(self):
-        if self._fileio is not None:
-            self._fileio.close()
-            self._fileio = None
-
-    def fileno(self):
-        if self._fileio is None:
-            try:
-                self._fileio = FileIO(
-                    os.open(self.path, self.flags | os.O_NONBLOCK),
-                    self.mode,
-                )
-                os.set_blocking(self._fileio.fileno(), False)
-            except OSError as e:
-                if e.errno != ENXIO:
-                    raise e
-        return self._fileio and self._fileio.fileno()
-
-
-def filter_fds(fds: list[LazyFD]):
-    return [fd for fd in fds if fd.fileno() is not None]
+from worker.management.commands.exceptions import (
+    OflowDetectedError,
+    StallDetectedError,
+    StopRequestedError,
+    StreamMismatchError,
+)
+from worker.management.commands.nalu import NALUScanner, get_sps_size
+from worker.management.commands.recorder import FFmpegRecorder, NativeRecorder
+from worker.management.commands.relay import (
+    EpollPoller,
+    LazyFD,
+    SelectPoller,
+    filter_fds,
+    splice_fds,
+)
+from worker.management.commands.ringbuffer import RingBuffer, SpillBuffer
+from worker.management.commands.utils import invalidate_probe_cache
+
+
+def can_read(buffer: RingBuffer, spill: SpillBuffer | None):
+    if spill is None:
+        return True
+    if len(spill):
+        return spill.free() > 0
+    return buffer.free() > 0 or spill.free() > 0
+
+
+def new_spill(camera: Camera, rate: float, buffer: RingBuffer):
+    # Hold SPILL_SECS of input at the highest bitrate seen so far
+    capacity = max(int(rate * SPILL_SECS), buffer.capacity)
+    print(f"{camera.id}: - Spilling up to {capacity} bytes to disk", flush=True)
+    return SpillBuffer(capacity, settings.SPILL_DIR)
+
+
+def read_input(in_fd: LazyFD, buffer: RingBuffer, spill: SpillBuffer | None):
+    # Once input has spilled, new input queues up behind it
+    if spill is not None and (len(spill) or not buffer.free()):
+        target = spill
+    else:
+        target = buffer
+    num_bytes = in_fd._fileio.readinto(target.write_span())
+    target.commit(num_bytes)
+    return num_bytes
+
+
+def unspill(buffer: RingBuffer, spill: SpillBuffer):
+    num_bytes = 0
+    while len(spill) and buffer.free():
+        span = buffer.write_span()
+        data = spill.read_span(len(span))
+        span[: len(data)] = data
+        buffer.commit(len(data))
+        spill.consume(len(data))
+        num_bytes += len(data)
+    return num_bytes
+
+
+def get_video_times(file_path: str, read_intervals: str | None = None):
+    # First PTS, and last PTS plus duration, of the video packets read, in
+    # seconds
+    params = {"select_streams": "v:0", "show_entries": "packet=pts_time,duration_time"}
+    if read_intervals is not None:
+        params["read_intervals"] = read_intervals
+    packets = ffmpeg.probe(file_path, **params).get("packets", [])
+    times = [
+        (float(packet["pts_time"]), float(packet.get("duration_time", 0)))
+        for packet in packets
+        if "pts_time" in packet
+    ]
+    return min(pts for pts, _ in times), max(pts + duration for pts, duration in times)
+
+
+def save_video(camera: Camera, file_path: str, record_path: str, start_date, end_date):
+    # Pre-warmed recordings are named before their first frame is known, so
+    # they take the time of the split they actually started at
+    if not Path(file_path).is_file():
+        return None
+    start_path = start_date.strftime(record_path)
+    if start_path != file_path:
+        os.replace(file_path, start_path)
+    Video.objects.create(
+        camera=camera,
+        start_date=start_date,
+        end_date=end_date,
+        file="/".join(start_path.split("/")[-3:]),
+    )
+    return start_path
+
+
+def measure_rollover(frame_rate: float, previous, file_path: str, gaps):
+    # Recordings are timed by frame count, so the previous one ends `frames`
+    # into the stream after its own start; whatever it or the next one lost or
+    # repeated around the split shows up as a gap or an overlap
+    previous_path, frames = previous
+    try:
+        # Seeking to where the previous recording should end only reads its
+        # last GOP or so
+        _, end = get_video_times(previous_path, f"{frames / frame_rate}%")
+        start, _ = get_video_times(file_path, "%+#1")
+    except (ffmpeg.Error, ValueError) as e:
+        print_exception(e)
+        return
+    gap = frames / frame_rate + start - end
+    gaps.append(gap)
+    print(
+        f"   === rollover gap = {gap * 1000:.1f} ms ({gap * frame_rate:.2f} frames) ===   ",
+        flush=True,
+    )
 
 
 def segment_hxxx(
     camera: Camera,
     frame_rate: float,
+    size,
     record_path: str,
     hxxx_in_codec: str,
     hxxx_in_path: str,
     has_audio: bool,
     rawaudio_in_path: str,
+    rawaudio_codec: str,
     rawaudio_params,
+    stop: Event | None = None,
 ):
-    read_buffer = bytearray(READ_MAX_SIZE)
-    read_buffer_view = memoryview(read_buffer)
+    native_enabled = settings.RECORD_MUXER == RECORD_MUXER_NATIVE
+    splice_enabled = settings.SEGMENTER_RELAY == RELAY_SPLICE and not native_enabled
+    poller = EpollPoller() if splice_enabled else SelectPoller()
+    pipe_size = RELAY_PIPE_SIZE if splice_enabled else 0
 
     hxxx_in_fd = LazyFD(hxxx_in_path, os.O_RDONLY, "r")
-    hxxx_buffer = bytearray()
+    hxxx_buffer = RingBuffer(HXXX_BUFFER_SIZE)
+    hxxx_spill, hxxx_rate = None, 0
+    hxxx_scanner = NALUScanner(hxxx_in_codec, track_units=native_enabled)
+    size_checked = False
     hxxx_in_stats, hxxx_out_stats = 0, 0
 
     rawaudio_in_fd = LazyFD(rawaudio_in_path, os.O_RDONLY, "r")
-    rawaudio_buffer = bytearray()
+    rawaudio_buffer = RingBuffer(RAWAUDIO_BUFFER_SIZE)
+    rawaudio_spill, rawaudio_rate = None, 0
     rawaudio_in_stats, rawaudio_out_stats = 0, 0
 
-    record_params = {
-        "movflags": "+faststart",
-        "vcodec": "copy",
-        "ar": AUDIO_RATE,
-    }
+    def start_recorder(file_path: str):
+        if native_enabled:
+            recorder = NativeRecorder(
+                file_path, frame_rate, size, has_audio, hxxx_scanner
+            )
+            print(f"{camera.id}: - Recording to {file_path}")
+        else:
+            recorder = FFmpegRecorder(
+                file_path,
+                frame_rate,
+                hxxx_in_codec,
+                has_audio,
+                rawaudio_codec,
+                rawaudio_params,
+                pipe_size,
+            )
+            print(f"{camera.id}: - Record process PID: {recorder.pid}")
+        return recorder
 
     current_date = timezone.now()
-    record_process = None
-    save_process, save_path, save_start, save_end = None, None, None, None
+    recorder, next_recorder = None, None
+    save_recorder, save_start, save_end = None, None, None
     start_date = None
 
+    # Media time between the end of one recording and the start of the next,
+    # measured from both files once they're saved; a recording's length in
+    # frames is known once it started and ended on indexed keyframes
+    segment_frame, segment_frames, save_frames = None, None, None
+    rollover_previous, rollover_gaps = None, []
+
     try:
         while True:
             start_date = current_date
@@ -105,41 +205,13 @@ def segment_hxxx(
                 second=randrange(59),
                 microsecond=randrange(999999),
             ) + timedelta(minutes=settings.RECORD_SEGMENT_MINS)
-            file_path = start_date.strftime(record_path)
-
-            hxxx_out_path = mkfifotemp(hxxx_in_codec)
-            hxxx_out_fd = LazyFD(hxxx_out_path, os.O_WRONLY, "w")
-
-            rawaudio_out_path = mkfifotemp(CODEC_RAWAUDIO)
-            rawaudio_out_fd = LazyFD(rawaudio_out_path, os.O_WRONLY, "w")
-
-            ffmpeg_inputs = [
-                ffmpeg.input(
-                    hxxx_out_path,
-                    framerate=frame_rate,
-                    thread_queue_size=4194304,
-                )
-            ]
-            if has_audio:
-                ffmpeg_inputs.append(
-                    ffmpeg.input(
-                        rawaudio_out_path,
-                        **rawaudio_params,
-                        thread_queue_size=262144,
-                    )
-                )
-
-            record_cmd = (
-                ffmpeg.output(
-                    *ffmpeg_inputs,
-                    file_path,
-                    **record_params,
-                )
-                .global_args(*FF_GLOBAL_ARGS)
-                .overwrite_output()
-            )
-            record_process = record_cmd.run_async()
-            print(f"{camera.id}: - Record process PID: {record_process.pid}")
+            prewarm_date = next_split - timedelta(seconds=RECORD_PREWARM_SECS)
+
+            if next_recorder is None:
+                next_recorder = start_recorder(start_date.strftime(record_path))
+            recorder, next_recorder = next_recorder, None
+            if native_enabled:
+                recorder.inherit(save_recorder)
 
             i = 0
             stat_check = perf_counter()
@@ -149,99 +221,201 @@ def segment_hxxx(
             while True:
                 i += 1
 
-                if save_process is not None and save_process.poll() is not None:
+                if stop is not None and stop.is_set():
+                    raise StopRequestedError()
+
+                if save_recorder is not None and save_recorder.done():
                     print("   ===  save point ===   ", flush=True)
-                    if Path(save_path).is_file():
-                        Video.objects.create(
-                            camera=camera,
-                            start_date=save_start,
-                            end_date=save_end,
-                            file="/".join(save_path.split("/")[-3:]),
-                        )
-                    else:
+                    save_path = save_video(
+                        camera,
+                        save_recorder.file_path,
+                        record_path,
+                        save_start,
+                        save_end,
+                    )
+                    if save_path is None:
                         print("   ===   no file!  ===   ", flush=True)
-                    save_process = None
-
-                should_split = timezone.now() > next_split
 
-                _rlist = filter_fds([hxxx_in_fd, rawaudio_in_fd])
-
-                _wlist = []
-                if len(hxxx_buffer):
-                    _wlist.append(hxxx_out_fd)
-                if len(rawaudio_buffer):
-                    _wlist.append(rawaudio_out_fd)
-                _wlist = filter_fds(_wlist)
-
-                rlist, wlist, _ = select(_rlist, _wlist, [], 1)
+                    if rollover_previous is not None and save_path is not None:
+                        Thread(
+                            target=measure_rollover,
+                            args=(
+                                frame_rate,
+                                rollover_previous,
+                                save_path,
+                                rollover_gaps,
+                            ),
+                            daemon=True,
+                        ).start()
+                    rollover_previous = None
+                    if save_frames is not None and save_path is not None:
+                        rollover_previous = (save_path, save_frames)
+                    save_recorder = None
+
+                now = timezone.now()
+                should_split = now > next_split
+
+                # Start the next writer ahead of the split so that rollover
+                # only has to swap recorders
+                if next_recorder is None and now > prewarm_date:
+                    next_recorder = start_recorder(next_split.strftime(record_path))
+                if next_recorder is not None:
+                    next_recorder.ready()
+
+                # Leave input in the FIFO while a buffer and its spill are full
+                _rlist = []
+                if can_read(hxxx_buffer, hxxx_spill):
+                    _rlist.append(hxxx_in_fd)
+                if can_read(rawaudio_buffer, rawaudio_spill):
+                    _rlist.append(rawaudio_in_fd)
+                _rlist = filter_fds(_rlist)
+
+                _wlist = recorder.wlist(hxxx_buffer, rawaudio_buffer)
+
+                rlist, wlist = poller.poll(_rlist, _wlist, 1)
+
+                num_out = 0
+
+                num_scan = 0
 
                 if hxxx_in_fd in rlist:
-                    num_bytes = hxxx_in_fd._fileio.readinto(read_buffer)
-                    hxxx_buffer.extend(read_buffer_view[:num_bytes])
+                    num_bytes = None
+                    # Nothing queued and no split point to look for, so let the
+                    # kernel move the data; fall back to copying if the output
+                    # isn't open yet or is full.
+                    if (
+                        splice_enabled
+                        and not should_split
+                        and not len(hxxx_buffer)
+                        and (hxxx_spill is None or not len(hxxx_spill))
+                    ):
+                        num_bytes = splice_fds(
+                            hxxx_in_fd, recorder.hxxx_out_fd, READ_MAX_SIZE
+                        )
+                        if num_bytes is not None:
+                            num_out += num_bytes
+                    if num_bytes is None:
+                        if hxxx_spill is None and not hxxx_buffer.free():
+                            hxxx_spill = new_spill(camera, hxxx_rate, hxxx_buffer)
+                        num_bytes = read_input(hxxx_in_fd, hxxx_buffer, hxxx_spill)
+                        num_scan += num_bytes
                     hxxx_in_stats += num_bytes
 
-                if hxxx_out_fd in wlist:
-                    if should_split:
-                        flush_to = hxxx_buffer.rfind(HXXX_NALU_HEADER)
-                        if flush_to == -1:
-                            flush_to = len(hxxx_buffer) - (HXXX_NALU_HEADER_SIZE - 1)
-                    else:
-                        flush_to = None
-
-                    num_bytes = hxxx_out_fd._fileio.write(
-                        memoryview(hxxx_buffer)[:flush_to]
+                if hxxx_spill is not None:
+                    num_scan += unspill(hxxx_buffer, hxxx_spill)
+                if num_scan:
+                    hxxx_scanner.scan(hxxx_buffer)
+
+                # The probe may have been cached before the camera's settings
+                # changed
+                if not size_checked and hxxx_scanner.sps is not None:
+                    size_checked = True
+                    try:
+                        sps_size = get_sps_size(hxxx_scanner.sps)
+                    except IndexError:
+                        sps_size = None
+                    if sps_size is not None and sps_size != tuple(size):
+                        print(
+                            f"{camera.id}: - Stream size {sps_size} doesn't match "
+                            f"probed size {size}",
+                            flush=True,
+                        )
+                        invalidate_probe_cache(camera.id)
+                        raise StreamMismatchError()
+
+                if should_split:
+                    split_offset = hxxx_scanner.next_keyframe(hxxx_buffer.read_offset)
+                    if split_offset is None:
+                        split_offset = hxxx_scanner.flush_offset()
+                    flush_to = max(split_offset - hxxx_buffer.read_offset, 0)
+                else:
+                    # Only scanned bytes go out, so that every frame is counted
+                    flush_to = max(
+                        hxxx_scanner.scan_offset - hxxx_buffer.read_offset, 0
                     )
-
-                    del hxxx_buffer[:num_bytes]
-                    hxxx_out_stats += num_bytes
+                num_out += recorder.write_hxxx(hxxx_buffer, flush_to, wlist)
+                hxxx_out_stats += num_out
 
                 if rawaudio_in_fd in rlist:
-                    num_bytes = rawaudio_in_fd._fileio.readinto(read_buffer)
-                    rawaudio_buffer.extend(read_buffer_view[:num_bytes])
-                    rawaudio_in_stats += num_bytes
-
-                if rawaudio_out_fd in wlist:
-                    flush_to = (
-                        len(rawaudio_buffer)
-                        // RAWAUDIO_SAMPLE_SIZE
-                        * RAWAUDIO_SAMPLE_SIZE
+                    if rawaudio_spill is None and not rawaudio_buffer.free():
+                        rawaudio_spill = new_spill(
+                            camera, rawaudio_rate, rawaudio_buffer
+                        )
+                    num_bytes = read_input(
+                        rawaudio_in_fd, rawaudio_buffer, rawaudio_spill
                     )
+                    rawaudio_in_stats += num_bytes
 
-                    num_bytes = rawaudio_out_fd._fileio.write(
-                        memoryview(rawaudio_buffer)[:flush_to]
-                    )
+                if rawaudio_spill is not None:
+                    unspill(rawaudio_buffer, rawaudio_spill)
 
-                    del rawaudio_buffer[:num_bytes]
-                    rawaudio_out_stats += num_bytes
+                rawaudio_out_stats += recorder.write_rawaudio(rawaudio_buffer, wlist)
 
                 if (
                     should_split
-                    and hxxx_buffer[:HXXX_NALU_HEADER_SIZE] == HXXX_NALU_HEADER
+                    and hxxx_scanner.next_keyframe(hxxx_buffer.read_offset)
+                    == hxxx_buffer.read_offset
                 ):
                     print("   === split point ===   ", flush=True)
+                    split_frame = hxxx_scanner.keyframe_frame(hxxx_buffer.read_offset)
+                    segment_frames = None
+                    if (
+                        segment_frame is not None
+                        and split_frame is not None
+                        and split_frame[1] == segment_frame[1]
+                    ):
+                        segment_frames = split_frame[0] - segment_frame[0]
+                    segment_frame = split_frame
                     break
 
                 if perf_counter() > stat_check:
+                    hxxx_rate = max(hxxx_rate, hxxx_in_stats / STAT_CHECK_PERIOD)
+                    rawaudio_rate = max(
+                        rawaudio_rate, rawaudio_in_stats / STAT_CHECK_PERIOD
+                    )
+                    hxxx_spilled = 0 if hxxx_spill is None else len(hxxx_spill)
+                    rawaudio_spilled = (
+                        0 if rawaudio_spill is None else len(rawaudio_spill)
+                    )
+
+                    # Spliced bytes aren't counted, so recordings' lengths in
+                    # frames aren't known
+                    rollover_stats = "-"
+                    if splice_enabled:
+                        rollover_stats = "unmeasured (splice)"
+                    elif len(rollover_gaps):
+                        rollover_stats = f"{rollover_gaps[-1] * 1000:.1f}ms"
                     print(
-                        f"V + {hxxx_in_stats:7} - {hxxx_out_stats:7} = {len(hxxx_buffer):8}          "
-                        f"A + {rawaudio_in_stats:7} - {rawaudio_out_stats:7} = {len(rawaudio_buffer):8}          "
-                        f"I = {i:6}     searching = {should_split}     saving = {save_process is not None}",
+                        f"V + {hxxx_in_stats:7} - {hxxx_out_stats:7} = {len(hxxx_buffer):8} + {hxxx_spilled:9}          "
+                        f"A + {rawaudio_in_stats:7} - {rawaudio_out_stats:7} = {len(rawaudio_buffer):8} + {rawaudio_spilled:9}          "
+                        f"I = {i:6}     searching = {should_split}     saving = {save_recorder is not None}     "
+                        f"next = {next_recorder is not None}     rollover = {rollover_stats}",
                         flush=True,
                     )
 
-                    if hxxx_in_stats == 0 or hxxx_out_stats == 0:
+                    # A recorder that stops reading is caught by the spill
+                    # filling up
+                    if hxxx_in_stats == 0:
                         stall_periods += 1
                     else:
                         stall_periods = 0
 
-                    if (
-                        len(hxxx_buffer) > HXXX_OFLOW
-                        or len(rawaudio_buffer) > RAWAUDIO_OFLOW
+                    if not can_read(hxxx_buffer, hxxx_spill) or not can_read(
+                        rawaudio_buffer, rawaudio_spill
                     ):
                         oflow_periods += 1
                     else:
                         oflow_periods = 0
 
+                    # Drained spills are released, and resized to the current
+                    # bitrate the next time they are needed
+                    if hxxx_spill is not None and not hxxx_spilled:
+                        hxxx_spill.close()
+                        hxxx_spill = None
+                    if rawaudio_spill is not None and not rawaudio_spilled:
+                        rawaudio_spill.close()
+                        rawaudio_spill = None
+
                     hxxx_in_stats, hxxx_out_stats = 0, 0
                     rawaudio_in_stats, rawaudio_out_stats = 0, 0
 
@@ -258,12 +432,11 @@ def segment_hxxx(
 
             current_date = timezone.now()
 
-            hxxx_out_fd.close()
-            rawaudio_out_fd.close()
-            record_process.terminate()
+            recorder.close()
 
-            save_process, save_path = record_process, file_path
+            save_recorder = recorder
             save_start, save_end = start_date, current_date
+            save_frames = segment_frames
 
     except BrokenPipeError as e:
         print_exception(e)
@@ -273,32 +446,26 @@ def segment_hxxx(
         print_exception(e)
         pass
 
-    except (StallDetectedError, OflowDetectedError):
+    except (
+        StallDetectedError,
+        OflowDetectedError,
+        StopRequestedError,
+        StreamMismatchError,
+    ):
         pass
 
-    hxxx_in_fd.close()
-    hxxx_out_fd.close()
+    poller.close()
 
+    hxxx_in_fd.close()
     rawaudio_in_fd.close()
-    rawaudio_out_fd.close()
-
-    if record_process is not None:
-        try:
-            record_process.wait(5)
-        except TimeoutExpired:
-            record_process.terminate()
-        try:
-            record_process.wait(5)
-        except TimeoutExpired:
-            record_process.kill()
-        record_process.wait()
-
-    if start_date is not None:
-        file_path = start_date.strftime(record_path)
-        if Path(file_path).is_file():
-            Video.objects.create(
-                camera=camera,
-                start_date=start_date,
-                end_date=timezone.now(),
-                file="/".join(file_path.split("/")[-3:]),
-            )
+
+    for spill in (hxxx_spill, rawaudio_spill):
+        if spill is not None:
+            spill.close()
+
+    if next_recorder is not None:
+        next_recorder.stop()
+
+    if recorder is not None:
+        recorder.stop()
+        save_video(camera, recorder.file_path, record_path, start_date, timezone.now())
@@ -1,46 +1,58 @@
+import asyncio
 from camera.models import Camera
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from multiprocessing import Process
-from os import kill, makedirs
+from os import getpid, kill, makedirs
+from os.path import dirname, join
 from shutil import rmtree
 from signal import SIGINT
 from subprocess import TimeoutExpired
-from time import sleep
+from tempfile import mkdtemp
+from time import monotonic, sleep
 
 from worker.management.commands.constants import (
-    AUDIO_RATE,
     CODEC_H264,
-    DECODE_SIZE,
-    CODEC_RAWAUDIO,
+    DECODE_SIZE_MAX,
+    DRAWBOX_DECODE_SIZE_MAX,
+    DRAWBOX_RENDERER_PYTHON,
+    PROBE_CACHE_MIN_UPTIME,
     RECORD_DIR,
     RECORD_FILENAME,
     STREAM_DIR,
 )
-from worker.management.commands.pipeline import load_model, run_pipeline
+from worker.management.commands.pipeline import (
+    load_model,
+    run_pipeline,
+    run_vector_pipeline,
+)
+from worker.management.commands.scheduler import get_scheduler, release_encoder_threads
 from worker.management.commands.segmenter import segment_hxxx
 from worker.management.commands.utils import (
     get_feature_config,
+    get_decode_size,
+    get_detect_stream_config,
+    get_drawbox_renderer,
     get_ffmpeg_cmds,
     get_hxxx_output,
+    get_keyframes_only,
+    get_rawaudio_output,
     get_stream_config,
+    get_vector_motion_enabled,
+    invalidate_probe_cache,
     mkfifotemp,
+    remove_temp_dirs,
 )
 
 
-def handle_stream(camera_id):
-    try:
-        camera = Camera.objects.get(pk=camera_id)
-    except Camera.DoesNotExist:
-        raise CommandError(f"Camera {camera_id} does not exist")
-
-    if not camera.enabled:
-        print(f"'{camera.name}' is disabled.")
-        return
+def setup_stream(camera: Camera, start_inference=None):
+    # `start_inference` starts an inference service when none is configured
+    # and returns its socket, instead of the camera loading a model
+    camera_id = camera.id
 
     stream_config = get_stream_config(camera)
-    stream_url, codec_name, size, frame_rate, has_audio, rtsp_params = stream_config
+    stream_url, codec_name, size, frame_rate, has_audio, audio_codec, _ = stream_config
     width, height = size
 
     print()
@@ -48,7 +60,8 @@ def handle_stream(camera_id):
     print(f"{camera_id}: - Codec:       {codec_name}")
     print(f"{camera_id}: - Size:        {width}x{height}")
     print(f"{camera_id}: - Frame rate:  {frame_rate}")
-    print(f"{camera_id}: - Audio:       {has_audio}", flush=True)
+    print(f"{camera_id}: - Audio:       {has_audio}")
+    print(f"{camera_id}: - Audio codec: {audio_codec}", flush=True)
 
     feature_config = get_feature_config(camera)
     detect_enabled, drawbox_enabled, drawtext_enabled = feature_config
@@ -59,30 +72,67 @@ def handle_stream(camera_id):
     print(f"{camera_id}:   - Visualization: {drawbox_enabled}")
     print(f"{camera_id}: - Text overlay:    {drawtext_enabled}", flush=True)
 
-    decode_enabled = detect_enabled
+    vector_motion_enabled = get_vector_motion_enabled(camera, feature_config)
     encode_enabled = drawtext_enabled or drawbox_enabled
     # copy_enabled = not encode_enabled and codec_name in HXXX_CODECS  # HEVC can't be played without browser hwaccel
     copy_enabled = not encode_enabled and codec_name == CODEC_H264
 
-    decode_size = DECODE_SIZE  # TODO: cap to `size`
+    # Visualization in Python draws on the decoded frames, which then get
+    # recorded; ffmpeg draws on the main stream's own frames instead
+    drawbox_renderer = None
+    if drawbox_enabled:
+        drawbox_renderer = get_drawbox_renderer(camera)
+    drawbox_frames = drawbox_renderer == DRAWBOX_RENDERER_PYTHON
+
+    detect_stream_config = None
+    if detect_enabled and not drawbox_frames:
+        detect_stream_config = get_detect_stream_config(camera)
+
+    # Only the H.264 decoder exports motion vectors
+    vector_stream_config = detect_stream_config or stream_config
+    if vector_motion_enabled and vector_stream_config[1] != CODEC_H264:
+        print(
+            f"{camera_id}: No motion vectors in {vector_stream_config[1]}; using pixels."
+        )
+        vector_motion_enabled = False
+    decode_enabled = detect_enabled and not vector_motion_enabled
+
+    decode_source_size = size
+    if detect_stream_config is not None:
+        decode_source_size = detect_stream_config[2]
+    decode_size = get_decode_size(
+        decode_source_size,
+        DRAWBOX_DECODE_SIZE_MAX if drawbox_frames else DECODE_SIZE_MAX,
+    )
     decode_width, decode_height = decode_size
 
+    # The main stream's decoder also feeds the encoder, unless it's copied
+    keyframes_only = False
+    if decode_enabled and get_keyframes_only(camera):
+        keyframes_only = not drawbox_enabled and (
+            detect_stream_config is not None or copy_enabled
+        )
+        if not keyframes_only:
+            print(f"{camera_id}: Can't decode only keyframes; decoding every frame.")
+
     print()
     print(f"{camera_id}: Pipeline configuration:")
     print(f"{camera_id}: - Decode:  {decode_enabled}")
+    if vector_motion_enabled:
+        print(f"{camera_id}:   - Motion vectors only")
     if decode_enabled:
         print(f"{camera_id}:   - Size:  {decode_width}x{decode_height}")
+        print(f"{camera_id}:   - Substream: {detect_stream_config is not None}")
+        print(f"{camera_id}:   - Keyframes only: {keyframes_only}")
     print(f"{camera_id}: - Encode:  {encode_enabled}")
+    if drawbox_enabled:
+        print(f"{camera_id}:   - Boxes: {drawbox_renderer}")
     print(f"{camera_id}: - Copy:    {copy_enabled}", flush=True)
 
     hxxx_codec = get_hxxx_output(codec_name)
     hxxx_out_path = mkfifotemp(hxxx_codec)
-    rawaudio_out_path = mkfifotemp(CODEC_RAWAUDIO)
-    rawaudio_params = {
-        "f": CODEC_RAWAUDIO,
-        "ar": AUDIO_RATE,  # TODO: adapt rate to source
-        "channel_layout": "mono",  # TODO: adapt layout to source
-    }
+    rawaudio_codec, rawaudio_params = get_rawaudio_output(audio_codec)
+    rawaudio_out_path = mkfifotemp(rawaudio_codec)
 
     record_dir = f"{settings.STORAGE_DIR}/{RECORD_DIR}/{camera.id}"
     makedirs(record_dir, exist_ok=True)
@@ -91,18 +141,73 @@ def handle_stream(camera_id):
     rmtree(stream_dir, ignore_errors=True)
     makedirs(stream_dir)
 
+    # Removed once the camera's processes are gone
+    temp_dirs = [dirname(hxxx_out_path), dirname(rawaudio_out_path)]
+
+    drawbox_address = None
+    if drawbox_enabled and not drawbox_frames:
+        temp_dirs.append(mkdtemp())
+        drawbox_address = f"ipc://{join(temp_dirs[-1], 'drawbox')}"
+
     ffmpeg_cmds = get_ffmpeg_cmds(
-        (copy_enabled, decode_width, decode_height),
-        feature_config,
+        camera_id,
+        (copy_enabled, decode_width, decode_height, keyframes_only),
+        (decode_enabled, drawbox_enabled, drawtext_enabled),
         hxxx_out_path,
         rawaudio_out_path,
         rawaudio_params,
         stream_config,
+        detect_stream_config,
         stream_dir,
+        drawbox_address,
+        vector_motion_enabled,
     )
 
-    if detect_enabled:
-        model = load_model(camera_id, decode_size)
+    # Visualization in Python re-encodes the decoded frames
+    hxxx_size = decode_size if drawbox_frames else size
+
+    segment_args = (
+        camera,
+        frame_rate,
+        hxxx_size,
+        f"{record_dir}/{RECORD_FILENAME}",
+        hxxx_codec,
+        hxxx_out_path,
+        has_audio,
+        rawaudio_out_path,
+        rawaudio_codec,
+        rawaudio_params,
+    )
+
+    pipeline, pipeline_args = None, ()
+    if vector_motion_enabled:
+        pipeline = run_vector_pipeline
+        pipeline_args = (camera_id, vector_stream_config)
+    elif detect_enabled:
+        model, inference_socket = None, settings.INFERENCE_SOCKET
+        if inference_socket is None and start_inference is not None:
+            inference_socket = start_inference()
+        if inference_socket is None:
+            model = load_model(camera_id, decode_size)
+        drawbox_config = None
+        if drawbox_address is not None:
+            drawbox_config = (drawbox_address, size)
+        pipeline = run_pipeline
+        pipeline_args = (
+            camera_id,
+            decode_size,
+            feature_config,
+            keyframes_only,
+            drawbox_config,
+            model,
+            inference_socket,
+        )
+
+    return ffmpeg_cmds, segment_args, pipeline, pipeline_args, temp_dirs
+
+
+def start_streams(camera: Camera, ffmpeg_cmds):
+    camera_id = camera.id
 
     print()
     print(f"{camera_id}: Starting streams...", flush=True)
@@ -119,37 +224,59 @@ def handle_stream(camera_id):
     camera.stream_start = timezone.now()
     camera.save()
 
+    return ff_processes
+
+
+def stop_streams(camera_id, ff_processes):
+    print()
+    print(f"{camera_id}: Signalling streams to stop...", flush=True)
+    for ff_process in ff_processes:
+        ff_process.terminate()
+        try:
+            ff_process.wait(5)
+        except TimeoutExpired:
+            ff_process.kill()
+        ff_process.wait()
+
+
+def handle_stream(camera_id):
+    try:
+        camera = Camera.objects.get(pk=camera_id)
+    except Camera.DoesNotExist:
+        raise CommandError(f"Camera {camera_id} does not exist")
+
+    if not camera.enabled:
+        print(f"'{camera.name}' is disabled.")
+        return
+
+    ffmpeg_cmds, segment_args, pipeline, pipeline_args, temp_dirs = setup_stream(camera)
+
+    ff_processes = start_streams(camera, ffmpeg_cmds)
+    started = monotonic()
+
     print()
     print(f"{camera_id}: Starting segmented recorder...", flush=True)
     record_process = Process(
         target=segment_hxxx,
-        args=(
-            camera,
-            frame_rate,
-            f"{record_dir}/{RECORD_FILENAME}",
-            hxxx_codec,
-            hxxx_out_path,
-            has_audio,
-            rawaudio_out_path,
-            rawaudio_params,
-        ),
+        args=segment_args,
         name=f"'{camera.name}'-record",
     )
     record_process.start()
     print(f"{camera_id}: Started segmented recorder.")
     print(f"{camera.id}: - Segmented recorder PID: {record_process.pid}")
 
+    # This process runs the camera's pipeline
+    scheduler = get_scheduler()
+    if scheduler is not None:
+        scheduler.attach(camera_id, "ffmpeg", [p.pid for p in ff_processes])
+        scheduler.attach(camera_id, "record", [record_process.pid])
+        scheduler.attach(camera_id, "pipeline", [getpid()])
+
     manual_exit = False
 
     try:
-        if detect_enabled:
-            run_pipeline(
-                camera_id,
-                decode_size,
-                feature_config,
-                ff_processes,
-                model,
-            )
+        if pipeline is not None:
+            pipeline(*pipeline_args, ff_processes)
         else:
             print()
             print(f"{camera_id}: Waiting for end of stream...", flush=True)
@@ -167,15 +294,7 @@ def handle_stream(camera_id):
     except KeyboardInterrupt:
         manual_exit = True
 
-    print()
-    print(f"{camera_id}: Signalling streams to stop...", flush=True)
-    for ff_process in ff_processes:
-        ff_process.terminate()
-        try:
-            ff_process.wait(5)
-        except TimeoutExpired:
-            ff_process.kill()
-        ff_process.wait()
+    stop_streams(camera_id, ff_processes)
 
     print()
     print(f"{camera_id}: Waiting for segmented recorder...", flush=True)
@@ -186,9 +305,17 @@ def handle_stream(camera_id):
             pass
     record_process.join()
 
+    if scheduler is not None:
+        scheduler.remove(camera_id)
+    release_encoder_threads(camera_id)
+    remove_temp_dirs(temp_dirs)
+
     print(f"{camera_id}: All done.")
 
     if not manual_exit:
+        # Whatever made the stream fail may have changed it too
+        if monotonic() - started < PROBE_CACHE_MIN_UPTIME:
+            invalidate_probe_cache(camera_id)
         exit(2)
 
 
@@ -197,9 +324,23 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--camera", type=int)
+        parser.add_argument(
+            "--supervisor",
+            action="store_true",
+            help="Run all camera control loops in this process",
+        )
 
     def handle(self, *args, **options):
-        if options.get("camera", None) is None:
+        if options["supervisor"]:
+            from worker.management.commands.supervisor import supervise
+
+            if options.get("camera", None) is None:
+                print("Supervising all cameras...")
+                camera_ids = list(Camera.objects.values_list("id", flat=True))
+            else:
+                camera_ids = [options["camera"]]
+            asyncio.run(supervise(camera_ids))
+        elif options.get("camera", None) is None:
             print("Streaming all cameras...")
             qs = Camera.objects.all()
             processes = [
@@ -0,0 +1,254 @@
+import asyncio
+from os import getpid, remove
+from os.path import exists
+from signal import SIGINT, SIGTERM
+from subprocess import Popen, TimeoutExpired
+from sys import executable
+from tempfile import gettempdir
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from traceback import print_exception
+
+from django.conf import settings
+from django.db import connections
+
+from camera.models import Camera
+from worker.management.commands.constants import (
+    PROBE_CACHE_MIN_UPTIME,
+    SUPERVISOR_BACKOFF_MAX,
+    SUPERVISOR_BACKOFF_MIN,
+    SUPERVISOR_BACKOFF_RESET,
+    SUPERVISOR_CHECK_PERIOD,
+    SUPERVISOR_INFERENCE_WAIT,
+)
+from worker.management.commands.scheduler import (
+    get_scheduler,
+    release_encoder_threads,
+    reserve_encoder_threads,
+    run_attached,
+)
+from worker.management.commands.segmenter import segment_hxxx
+from worker.management.commands.stream import (
+    setup_stream,
+    start_streams,
+    stop_streams,
+)
+from worker.management.commands.utils import invalidate_probe_cache, remove_temp_dirs
+
+
+async def run_in_thread(name: str, func, *args):
+    # Long-running loops get their own thread rather than one from the default
+    # executor, which they would starve, and may set their own CPU affinity
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def set_exception(e):
+        if not future.done():
+            future.set_exception(e)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:  # noqa: BLE001
+            loop.call_soon_threadsafe(set_exception, e)
+        else:
+            loop.call_soon_threadsafe(set_result, result)
+        finally:
+            connections.close_all()
+
+    Thread(target=target, name=name, daemon=True).start()
+    return await future
+
+
+class InferenceService:
+    # Without INFERENCE_SOCKET, the cameras share an `infer` process started on
+    # first use, rather than each running a model in this process, where it
+    # would hold up every camera's recording under the one GIL
+    def __init__(self):
+        self.address = f"{gettempdir()}/mirador-infer-{getpid()}.sock"
+        self.process = None
+        self.lock = Lock()
+
+    def start(self):
+        # (Re)started if need be; returns the socket once it's served
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                try:
+                    remove(self.address)
+                except FileNotFoundError:
+                    pass
+                print("Starting inference service...", flush=True)
+                manage_path = settings.BASE_DIR / "manage.py"
+                self.process = Popen(
+                    [executable, manage_path, "infer", "--socket", self.address]
+                )
+                print(f"- Inference service PID: {self.process.pid}")
+
+            while not exists(self.address):
+                if self.process.poll() is not None:
+                    raise RuntimeError(
+                        f"Inference service ended. RC: {self.process.returncode}"
+                    )
+                sleep(SUPERVISOR_INFERENCE_WAIT)
+        return self.address
+
+    def stop(self):
+        with self.lock:
+            if self.process is None:
+                return
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except TimeoutExpired:
+                self.process.kill()
+            self.process.wait()
+
+
+async def wait_for_stop(stop: asyncio.Event, timeout: float):
+    try:
+        await asyncio.wait_for(stop.wait(), timeout)
+    except TimeoutError:
+        pass
+
+
+async def run_camera(camera_id, inference: InferenceService, stop: asyncio.Event):
+    try:
+        camera = await asyncio.to_thread(Camera.objects.get, pk=camera_id)
+    except Camera.DoesNotExist:
+        print(f"Camera {camera_id} does not exist.")
+        return False
+    if not camera.enabled:
+        print(f"'{camera.name}' is disabled.")
+        return False
+
+    ff_processes = []
+    temp_dirs = []
+    scheduler = None
+    segment_stop = Event()
+    workers = []
+    started = monotonic()
+
+    # Whatever fails along the way, everything started so far gets stopped
+    # before the camera is restarted
+    try:
+        (
+            ffmpeg_cmds,
+            segment_args,
+            pipeline,
+            pipeline_args,
+            temp_dirs,
+        ) = await asyncio.to_thread(setup_stream, camera, inference.start)
+
+        ff_processes = await asyncio.to_thread(start_streams, camera, ffmpeg_cmds)
+        started = monotonic()
+
+        # The camera's threads get scheduled along with its ffmpeg processes
+        scheduler = await asyncio.to_thread(get_scheduler)
+        if scheduler is not None:
+            pids = [ff_process.pid for ff_process in ff_processes]
+            await asyncio.to_thread(scheduler.attach, camera_id, "ffmpeg", pids)
+
+        workers.append(
+            asyncio.create_task(
+                run_in_thread(
+                    f"'{camera.name}'-record",
+                    run_attached,
+                    camera_id,
+                    "record",
+                    segment_hxxx,
+                    *segment_args,
+                    segment_stop,
+                )
+            )
+        )
+        if pipeline is not None:
+            workers.append(
+                asyncio.create_task(
+                    run_in_thread(
+                        f"'{camera.name}'-pipeline",
+                        run_attached,
+                        camera_id,
+                        "pipeline",
+                        pipeline,
+                        *pipeline_args,
+                        ff_processes,
+                    )
+                )
+            )
+
+        while (
+            not stop.is_set()
+            and all(p.poll() is None for p in ff_processes)
+            and not any(w.done() for w in workers)
+        ):
+            await wait_for_stop(stop, SUPERVISOR_CHECK_PERIOD)
+
+        rcs = [ff_process.poll() for ff_process in ff_processes]
+        print(f"{camera_id}: Stream ended. RCs: {rcs}, stop = {stop.is_set()}")
+
+    finally:
+        await asyncio.to_thread(stop_streams, camera_id, ff_processes)
+
+        print()
+        print(f"{camera_id}: Waiting for segmented recorder...", flush=True)
+        segment_stop.set()
+        for result in await asyncio.gather(*workers, return_exceptions=True):
+            if isinstance(result, BaseException):
+                print_exception(result)
+
+        if scheduler is not None:
+            await asyncio.to_thread(scheduler.remove, camera_id)
+        # The camera gets the same encoder share back when it restarts
+        await asyncio.to_thread(release_encoder_threads, camera_id, True)
+        remove_temp_dirs(temp_dirs)
+
+    # Whatever made the stream fail may have changed it too
+    if not stop.is_set() and monotonic() - started < PROBE_CACHE_MIN_UPTIME:
+        invalidate_probe_cache(camera_id)
+
+    print(f"{camera_id}: All done.")
+    return True
+
+
+async def supervise_camera(camera_id, inference: InferenceService, stop: asyncio.Event):
+    backoff = SUPERVISOR_BACKOFF_MIN
+
+    while not stop.is_set():
+        started = monotonic()
+        try:
+            if not await run_camera(camera_id, inference, stop):
+                await asyncio.to_thread(release_encoder_threads, camera_id)
+                return
+        except Exception as e:  # noqa: BLE001
+            print_exception(e)
+
+        if stop.is_set():
+            return
+
+        # Only back off further while the camera keeps failing quickly
+        if monotonic() - started > SUPERVISOR_BACKOFF_RESET:
+            backoff = SUPERVISOR_BACKOFF_MIN
+
+        print(f"{camera_id}: Restarting in {backoff}s...", flush=True)
+        await wait_for_stop(stop, backoff)
+        backoff = min(backoff * 2, SUPERVISOR_BACKOFF_MAX)
+
+
+async def supervise(camera_ids):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal in (SIGINT, SIGTERM):
+        loop.add_signal_handler(signal, stop.set)
+
+    reserve_encoder_threads(camera_ids)
+    inference = InferenceService()
+    try:
+        await asyncio.gather(
+            *(supervise_camera(camera_id, inference, stop) for camera_id in camera_ids)
+        )
+    finally:
+        await asyncio.to_thread(inference.stop)
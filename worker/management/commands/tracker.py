@@ -0,0 +1,112 @@
+import numpy as np
+
+from worker.management.commands.constants import (
+    PROPAGATE_MAX_SECS,
+    TRACKER_IOU_MIN,
+    TRACKER_MAX_AGE,
+)
+
+
+def get_ious(boxes_a, boxes_b):
+    # Boxes are rows of x1, y1, x2, y2
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+class IoUTracker:
+    def __init__(
+        self, iou_min: float = TRACKER_IOU_MIN, max_age: int = TRACKER_MAX_AGE
+    ):
+        self.iou_min = iou_min
+        self.max_age = max_age
+
+        # Rows of x1, y1, x2, y2, class, track ID, frames since last seen
+        self._tracks = np.zeros((0, 7))
+        self._next_id = 1
+
+    def update(self, detections):
+        # `detections` are rows of x1, y1, x2, y2, confidence, class; returns
+        # them with a track ID appended
+        track_ids = np.zeros(len(detections))
+
+        matched_tracks = set()
+        if len(self._tracks) and len(detections):
+            ious = get_ious(self._tracks[:, :4], detections[:, :4])
+            ious[self._tracks[:, 4, None] != detections[None, :, 5]] = 0
+
+            # Greedily pair the most overlapping boxes first
+            for track_index, detection_index in zip(
+                *np.unravel_index(np.argsort(-ious, axis=None), ious.shape)
+            ):
+                if ious[track_index, detection_index] < self.iou_min:
+                    break
+                if track_index in matched_tracks or track_ids[detection_index]:
+                    continue
+                matched_tracks.add(track_index)
+                track_ids[detection_index] = self._tracks[track_index, 5]
+                self._tracks[track_index, :4] = detections[detection_index, :4]
+                self._tracks[track_index, 6] = -1
+
+        new_tracks = []
+        for detection_index in np.flatnonzero(track_ids == 0):
+            track_ids[detection_index] = self._next_id
+            new_tracks.append(
+                [
+                    *detections[detection_index, :4],
+                    detections[detection_index, 5],
+                    self._next_id,
+                    0,
+                ]
+            )
+            self._next_id += 1
+
+        self._tracks[:, 6] += 1
+        self._tracks = self._tracks[self._tracks[:, 6] <= self.max_age]
+        if len(new_tracks):
+            self._tracks = np.vstack([self._tracks, new_tracks])
+
+        return np.column_stack([detections[:, :6], track_ids])
+
+
+class BoxPropagator:
+    # Moves the last inferred boxes along each track's velocity until the
+    # next inference
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._detections = np.zeros((0, 7))
+        self._velocities = np.zeros((0, 4))
+        self._time = None
+
+    def update(self, detections, now: float):
+        velocities = np.zeros((len(detections), 4))
+        if self._time is not None and now > self._time and len(self._detections):
+            previous = {
+                track_id: box for *box, track_id in self._detections[:, [0, 1, 2, 3, 6]]
+            }
+            for i, detection in enumerate(detections):
+                box = previous.get(detection[6])
+                if detection[6] and box is not None:
+                    velocities[i] = (detection[:4] - box) / (now - self._time)
+
+        self._detections = detections
+        self._velocities = velocities
+        self._time = now
+        return detections
+
+    def propagate(self, now: float):
+        if self._time is None:
+            return self._detections
+        elapsed = min(now - self._time, PROPAGATE_MAX_SECS)
+        detections = self._detections.copy()
+        detections[:, :4] += self._velocities * elapsed
+        return detections
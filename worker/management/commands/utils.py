@@ -1,17 +1,40 @@
+from hashlib import sha256
+import json
 from sys import stderr
+from time import time
 
 import ffmpeg
-from camera.models import Camera
+from camera.models import Camera, Stream
+from django.conf import settings
 from django.core.management import CommandError
-from os import mkfifo
+from os import makedirs, mkfifo, remove, replace
 from os.path import join
-from tempfile import mkdtemp
+from shutil import rmtree
+from tempfile import NamedTemporaryFile, mkdtemp
 from worker.management.commands.constants import (
     AUDIO_RATE,
+    CODEC_ADTS,
     CODEC_H264,
+    CODEC_RAWAUDIO,
+    DETECT_RATE_DEFAULT,
+    DRAWBOX_RENDERER_PYTHON,
+    DRAWBOX_RENDERER_ZMQ,
+    ENCODER_FILTERS,
+    ENCODER_PARAMS,
     FF_GLOBAL_ARGS,
     FF_GLOBAL_PARAMS,
     FF_RTSP_DEFAULT_PARAMS,
+    MOTION_MODE_VECTORS,
+    PROBE_CACHE_DIR,
+    RECORD_AUDIO_COPY,
+    RECORD_AUDIO_COPY_CODECS,
+    RECORD_MUXER_NATIVE,
+)
+from worker.management.commands.capabilities import get_capabilities, get_filters
+from worker.management.commands.drawbox import add_drawbox_filters
+from worker.management.commands.scheduler import (
+    get_x264_params,
+    release_encoder_threads,
 )
 
 
@@ -25,6 +48,73 @@ def get_detection_settings(camera: Camera, settings_type: str, detection: bool =
         return False, False
 
 
+def get_detection_rates(camera_id):
+    camera = Camera.objects.get(pk=camera_id)
+    if hasattr(camera, "objectdetectionsettings"):
+        ds = camera.objectdetectionsettings
+        return ds.idle_rate, ds.active_rate
+    else:
+        return DETECT_RATE_DEFAULT
+
+
+def get_keyframes_only(camera: Camera):
+    if hasattr(camera, "objectdetectionsettings"):
+        return camera.objectdetectionsettings.keyframes_only
+    else:
+        return False
+
+
+def get_motion_settings(camera_id):
+    camera = Camera.objects.get(pk=camera_id)
+    if hasattr(camera, "motiondetectionsettings"):
+        ds = camera.motiondetectionsettings
+        regions = [r.points for r in ds.regions.filter(enabled=True)]
+        return ds.enabled, ds.sensitivity, regions
+    else:
+        return False, 0, []
+
+
+def get_vector_motion_enabled(camera: Camera, feature_config):
+    # Motion vectors only save anything if no other detector needs the
+    # decoded frames
+    _, drawbox_enabled, _ = feature_config
+    md_enable, _ = get_detection_settings(camera, "motion")
+    if not md_enable or drawbox_enabled:
+        return False
+    if camera.motiondetectionsettings.mode != MOTION_MODE_VECTORS:
+        return False
+    if any(
+        [
+            get_detection_settings(camera, "object")[0],
+            get_detection_settings(camera, "face")[0],
+            get_detection_settings(camera, "alpr", False)[0],
+        ]
+    ):
+        return False
+
+    try:
+        import av  # noqa: F401
+    except ImportError:
+        print(f"{camera.pk}: PyAV not installed; detecting motion from pixels.")
+        return False
+    return True
+
+
+def get_drawbox_renderer(camera: Camera):
+    if settings.DRAWBOX_RENDERER != DRAWBOX_RENDERER_ZMQ:
+        return DRAWBOX_RENDERER_PYTHON
+
+    try:
+        import zmq  # noqa: F401
+    except ImportError:
+        print(f"{camera.pk}: pyzmq not installed; drawing boxes in Python.")
+        return DRAWBOX_RENDERER_PYTHON
+    if not all(f in get_filters() for f in ["zmq", "drawbox", "drawtext"]):
+        print(f"{camera.pk}: ffmpeg can't draw boxes itself; drawing them in Python.")
+        return DRAWBOX_RENDERER_PYTHON
+    return DRAWBOX_RENDERER_ZMQ
+
+
 def get_feature_config(camera: Camera):
     md_enable, md_visualize = get_detection_settings(camera, "motion")
     od_enable, od_visualize = get_detection_settings(camera, "object")
@@ -39,18 +129,24 @@ def get_feature_config(camera: Camera):
 
 
 def get_ffmpeg_cmds(
+    camera_id,
     decode_config,
     feature_config,
     hxxx_out_path: str,
     rawaudio_out_path: str,
     rawaudio_params,
     stream_config,
+    detect_stream_config,
     stream_dir: str,
+    drawbox_address: str | None = None,
+    vector_motion_enabled: bool = False,
 ):
-    copy_enabled, decode_width, decode_height = decode_config
+    copy_enabled, decode_width, decode_height, keyframes_only = decode_config
     detect_enabled, drawbox_enabled, drawtext_enabled = feature_config
-    stream_url, codec_name, _, frame_rate, has_audio, rtsp_params = stream_config
-    decode_params, encode_params = get_transcode_params(copy_enabled)
+    stream_url, codec_name, size, frame_rate, has_audio, _, rtsp_params = stream_config
+    decode_params, encode_params = get_transcode_params(
+        camera_id, copy_enabled, size, frame_rate
+    )
 
     rawvideo_params = {
         "format": "rawvideo",
@@ -58,21 +154,46 @@ def get_ffmpeg_cmds(
         "s": f"{decode_width}x{decode_height}",
     }
 
+    # Skipped frames must not be made up for by duplicating keyframes
+    keyframe_params = {}
+    if keyframes_only:
+        keyframe_params["skip_frame:v"] = "nokey"
+        rawvideo_params["fps_mode"] = "passthrough"
+
     inputs = [
         ffmpeg.input(
             stream_url,
             **decode_params,
+            **(keyframe_params if detect_stream_config is None else {}),
             **rtsp_params,
         )
     ]
     outputs = [[]]
 
     if detect_enabled:
-        decode_scaled = inputs[-1].filter("scale", decode_width, decode_height)
+        decode_input = inputs[-1]
+        if detect_stream_config is not None:
+            detect_url, *_, detect_rtsp_params = detect_stream_config
+            decode_input = ffmpeg.input(
+                detect_url, **keyframe_params, **detect_rtsp_params
+            )
+        decode_scaled = decode_input.filter("scale", decode_width, decode_height)
         outputs[-1].append(decode_scaled.output("pipe:", **rawvideo_params))
 
-    if drawbox_enabled:
-        inputs.append(ffmpeg.input("pipe:", **rawvideo_params))
+    # Motion vectors are decoded from the stream as it comes
+    if vector_motion_enabled:
+        vector_input = inputs[-1]
+        if detect_stream_config is not None:
+            detect_url, *_, detect_rtsp_params = detect_stream_config
+            vector_input = ffmpeg.input(detect_url, **detect_rtsp_params)
+        outputs[-1].append(
+            vector_input["v"].output("pipe:", vcodec="copy", format=CODEC_H264)
+        )
+
+    # Boxes are either drawn by the pipeline on the decoded frames, which come
+    # back to be encoded, or by this ffmpeg on its own frames
+    if drawbox_enabled and drawbox_address is None:
+        inputs.append(ffmpeg.input("pipe:", framerate=frame_rate, **rawvideo_params))
         outputs.append([])
 
     if drawtext_enabled:
@@ -93,7 +214,13 @@ def get_ffmpeg_cmds(
     def teeify(params):
         return ":".join(f"{k}={v}" for k, v in params.items())
 
-    tee_inputs = [inputs[-1]["v"]]
+    tee_video = inputs[-1]["v"]
+    if drawbox_enabled and drawbox_address is not None:
+        tee_video = add_drawbox_filters(tee_video, drawbox_address)
+    for filter_args in ENCODER_FILTERS.get(encode_params["vcodec"], []):
+        tee_video = tee_video.filter(*filter_args)
+
+    tee_inputs = [tee_video]
     if has_audio:
         tee_inputs.append(inputs[-1]["a"])
 
@@ -142,18 +269,122 @@ def get_hxxx_output(codec: str):
     return CODEC_H264
 
 
+def get_rawaudio_output(audio_codec: str | None):
+    # The native muxer only takes ADTS
+    if (
+        settings.RECORD_AUDIO != RECORD_AUDIO_COPY
+        and settings.RECORD_MUXER != RECORD_MUXER_NATIVE
+    ):
+        return CODEC_RAWAUDIO, {
+            "f": CODEC_RAWAUDIO,
+            "ar": AUDIO_RATE,
+            "channel_layout": "mono",
+        }
+
+    # Keep the source's packets when MP4 can hold them, otherwise encode to
+    # AAC once at the source's rate and layout
+    acodec = "copy" if audio_codec in RECORD_AUDIO_COPY_CODECS else "aac"
+    return CODEC_ADTS, {"f": CODEC_ADTS, "acodec": acodec}
+
+
 def get_stream(probe, codec_type: str):
     return next((s for s in probe["streams"] if s["codec_type"] == codec_type), None)
 
 
+def get_probe_cache_path(camera_id):
+    return f"{settings.STORAGE_DIR}/{PROBE_CACHE_DIR}/{camera_id}.json"
+
+
+def get_probe_cache_key(stream_url: str, rtsp_params):
+    # Hashed so that camera credentials don't end up in the cache
+    key = json.dumps([stream_url, rtsp_params], sort_keys=True)
+    return sha256(key.encode()).hexdigest()
+
+
+def read_probe_cache(camera_id):
+    # One entry per probed stream of the camera
+    try:
+        with open(get_probe_cache_path(camera_id)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return {
+        key: entry
+        for key, entry in cache.items()
+        if isinstance(entry, dict)
+        and time() - entry.get("time", 0) <= settings.PROBE_CACHE_TTL
+    }
+
+
+def load_probe_cache(camera_id, key: str):
+    entry = read_probe_cache(camera_id).get(key)
+    return None if entry is None else entry["config"]
+
+
+def save_probe_cache(camera_id, key: str, config):
+    cache = read_probe_cache(camera_id)
+    cache[key] = {"time": time(), "config": config}
+
+    cache_dir = f"{settings.STORAGE_DIR}/{PROBE_CACHE_DIR}"
+    makedirs(cache_dir, exist_ok=True)
+    with NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+        json.dump(cache, f)
+    replace(f.name, get_probe_cache_path(camera_id))
+
+
+def invalidate_probe_cache(camera_id):
+    try:
+        remove(get_probe_cache_path(camera_id))
+    except FileNotFoundError:
+        pass
+
+
+def get_streams(camera: Camera):
+    streams = list(camera.camera_type.streams.all())
+    if not len(streams):
+        raise CommandError(f"{camera.pk}: Camera type has no streams.")
+
+    main_stream = next((s for s in streams if not s.detection), streams[0])
+    detect_stream = next(
+        (s for s in streams if s.detection and s.enabled and s != main_stream), None
+    )
+    return main_stream, detect_stream
+
+
 def get_stream_config(camera: Camera):
-    stream_url = camera.urls()[0]
+    return probe_stream(camera, get_streams(camera)[0])
+
+
+def get_detect_stream_config(camera: Camera):
+    detect_stream = get_streams(camera)[1]
+    if detect_stream is None:
+        return None
+    return probe_stream(camera, detect_stream)
+
+
+def probe_stream(camera: Camera, stream: Stream):
+    stream_url = camera.url(stream)
 
     rtsp_params = {**FF_RTSP_DEFAULT_PARAMS}
-    if camera.camera_type.streams.all()[0].force_tcp:
+    if stream.force_tcp:
         rtsp_params["rtsp_transport"] = "tcp"
 
-    print(f"{camera.pk}: Probing camera...", flush=True)
+    cache_key = get_probe_cache_key(stream_url, rtsp_params)
+    cached = load_probe_cache(camera.pk, cache_key)
+    if cached is not None:
+        print(f"{camera.pk}: Using cached probe of '{stream.name}'.", flush=True)
+        return (
+            stream_url,
+            cached["codec"],
+            tuple(cached["size"]),
+            cached["frame_rate"],
+            cached["has_audio"],
+            cached["audio_codec"],
+            rtsp_params,
+        )
+
+    print(f"{camera.pk}: Probing '{stream.name}'...", flush=True)
     try:
         probe = ffmpeg.probe(
             stream_url,
@@ -177,36 +408,69 @@ def get_stream_config(camera: Camera):
         frame_rate = get_frame_rate(video_stream, "r_frame_rate")
 
     # TODO: allow disabling audio
-    has_audio = get_stream(probe, "audio") is not None
+    audio_stream = get_stream(probe, "audio")
+    has_audio = audio_stream is not None
     # has_audio = False
+    audio_codec = audio_stream["codec_name"] if has_audio else None
+
+    if settings.PROBE_CACHE_TTL:
+        save_probe_cache(
+            camera.pk,
+            cache_key,
+            {
+                "codec": codec,
+                "size": size,
+                "frame_rate": frame_rate,
+                "has_audio": has_audio,
+                "audio_codec": audio_codec,
+            },
+        )
+
+    return stream_url, codec, size, frame_rate, has_audio, audio_codec, rtsp_params
 
-    return stream_url, codec, size, frame_rate, has_audio, rtsp_params
 
+def get_decode_size(size, max_size: int):
+    # Keeps the aspect ratio and never upscales; rawvideo scaling wants even
+    # dimensions
+    width, height = size
+    scale = min(max_size / max(width, height), 1)
+    return (
+        max(round(width * scale / 2) * 2, 2),
+        max(round(height * scale / 2) * 2, 2),
+    )
 
-def get_transcode_params(copy_enabled: bool):
-    # TODO: actually detect hwaccel
-    # TODO: allow disabling hwaccel
-    nvdec_available = True
-    nvenc_available = True
-    vaapi_available = False
 
+def get_transcode_params(camera_id, copy_enabled: bool, size, frame_rate: float):
     decode_params = {}
-    encode_params = {"vcodec": "libx264"}
-
-    if copy_enabled:
-        pass
-    elif nvdec_available:
-        decode_params["hwaccel"] = "cuda"
-    elif vaapi_available:
-        decode_params["hwaccel"] = "vaapi"
+    encode_params = {}
 
     if copy_enabled:
+        release_encoder_threads(camera_id)
         encode_params["vcodec"] = "copy"
-    elif nvenc_available:
-        encode_params["vcodec"] = "h264_nvenc"
-        encode_params["bf"] = 0
-    elif vaapi_available:
-        encode_params["vcodec"] = "h264_vaapi"
+        return decode_params, encode_params
+
+    hwaccels, encoders = [], ["libx264"]
+    if settings.TRANSCODE_HWACCEL:
+        capabilities = get_capabilities()
+        hwaccels, encoders = capabilities["hwaccels"], capabilities["encoders"]
+
+    if len(hwaccels):
+        decode_params["hwaccel"] = hwaccels[0]
+
+    vcodec = encoders[0] if len(encoders) else "libx264"
+    encode_params["vcodec"] = vcodec
+    encode_params.update(ENCODER_PARAMS.get(vcodec, {}))
+    if vcodec == "libx264":
+        threads, preset, lookahead = get_x264_params(camera_id, size, frame_rate)
+        encode_params["threads"] = threads
+        encode_params["preset"] = preset
+        encode_params["rc-lookahead"] = lookahead
+        print(
+            f"{camera_id}: - x264: {threads} threads, {preset}, lookahead {lookahead}",
+            flush=True,
+        )
+    else:
+        release_encoder_threads(camera_id)
 
     return decode_params, encode_params
 
@@ -215,3 +479,8 @@ def mkfifotemp(ext: str):
     path = join(mkdtemp(), f"tmp.{ext}")
     mkfifo(path)
     return path
+
+
+def remove_temp_dirs(paths):
+    for path in paths:
+        rmtree(path, ignore_errors=True)